@@ -0,0 +1,131 @@
+# Copyright (c) 2009-2014, Christian Haintz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+#     * Neither the name of callme nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""Compare the encode/decode cost and the message size of the serializers.
+
+Usage::
+
+    $ PYTHONPATH=. python benchmarks/serializers.py [--number N] [--json]
+"""
+
+import argparse
+import json
+import sys
+import timeit
+
+from kombu import serialization
+
+from callme import protocol as pr
+
+PAYLOADS = {
+    'scalar': 42,
+    'small_dict': {'id': 1, 'name': 'foo', 'active': True},
+    'records': [{'id': i, 'name': 'record {0}'.format(i), 'score': i * 0.5,
+                 'tags': ['a', 'b', 'c']} for i in range(1000)],
+}
+
+
+def _roundtrip(serializer, message):
+    content_type, content_encoding, data = serialization.dumps(
+        pr.encode(message, serializer), serializer=serializer)
+    return pr.decode(serialization.loads(
+        data, content_type, content_encoding,
+        accept=[content_type]))
+
+
+def bench(serializer, payload, number):
+    """Measure one serializer with one payload.
+
+    :rtype: dictionary with the times in microseconds per message and the
+        message sizes in bytes
+    """
+    request = pr.RpcRequest('func', [payload], {})
+    response = pr.RpcResponse(payload)
+    result = {'serializer': serializer}
+    for kind, message in (('request', request), ('response', response)):
+        body = pr.encode(message, serializer)
+        content_type, content_encoding, data = serialization.dumps(
+            body, serializer=serializer)
+        encode = timeit.timeit(
+            lambda: serialization.dumps(pr.encode(message, serializer),
+                                        serializer=serializer),
+            number=number)
+        decode = timeit.timeit(
+            lambda: pr.decode(serialization.loads(
+                data, content_type, content_encoding,
+                accept=[content_type])),
+            number=number)
+        result[kind + '_size'] = len(data)
+        result[kind + '_encode_us'] = encode / number * 1e6
+        result[kind + '_decode_us'] = decode / number * 1e6
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--number', type=int, default=1000,
+                        help='number of messages per measurement')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    args = parser.parse_args(argv)
+
+    results = []
+    for name, payload in sorted(PAYLOADS.items()):
+        for serializer in pr.SERIALIZERS:
+            try:
+                _roundtrip(serializer, pr.RpcRequest('func', [payload], {}))
+            except Exception as e:
+                sys.stderr.write("Skipping {0}: {1}\n".format(serializer, e))
+                continue
+            result = bench(serializer, payload, args.number)
+            result['payload'] = name
+            results.append(result)
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+
+    row = "{0:<12} {1:<10} {2:>10} {3:>12} {4:>12} {5:>10} {6:>12} {7:>12}"
+    print(row.format('payload', 'serializer', 'req bytes', 'req enc us',
+                     'req dec us', 'resp bytes', 'resp enc us',
+                     'resp dec us'))
+    for r in results:
+        print(row.format(r['payload'], r['serializer'],
+                         r['request_size'],
+                         '{0:.1f}'.format(r['request_encode_us']),
+                         '{0:.1f}'.format(r['request_decode_us']),
+                         r['response_size'],
+                         '{0:.1f}'.format(r['response_encode_us']),
+                         '{0:.1f}'.format(r['response_decode_us'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -29,7 +29,12 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import sys
+
 from callme.proxy import Proxy      # noqa
 from callme.server import Server    # noqa
 
+if sys.version_info >= (3, 5):
+    from callme.aioproxy import AsyncProxy  # noqa
+
 __version__ = '0.2.0'
@@ -0,0 +1,197 @@
+# Copyright (c) 2009-2014, Christian Haintz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+#     * Neither the name of callme nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import functools
+import logging
+import threading
+import time
+
+from callme import exceptions as exc
+from callme import proxy
+
+LOG = logging.getLogger(__name__)
+
+
+class AsyncProxy(proxy.Proxy):
+    """This AsyncProxy class is the asyncio flavour of :class:`Proxy`, the
+    remote-methods are coroutines.
+
+    Typical use:
+
+        >> result = await my_proxy.use_server(timeout=5).a_remote_func()
+
+    The responses are drained by a single background thread which resolves
+    the awaiting coroutines on their event loop, so the event loop is never
+    blocked waiting for the broker. Publishing a request is done from the
+    calling coroutine, a request with uploaded arguments is published by a
+    thread of the default executor of the event loop.
+
+    The call of a generator function returns an :class:`AsyncResultStream`
+    to be iterated with ``async for``.
+
+    It takes the same keywords as :class:`Proxy`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncProxy, self).__init__(*args, **kwargs)
+        self._closed = threading.Event()
+        self._drainer = None
+        self._drainer_lock = threading.Lock()
+
+    def _ensure_drainer(self):
+        """Start the background thread draining the responses."""
+        with self._drainer_lock:
+            if self._drainer is None:
+                self._drainer = threading.Thread(target=self._drain_forever)
+                self._drainer.daemon = True
+                self._drainer.start()
+
+    def _drain_forever(self):
+        while not self._closed.is_set():
+            try:
+                self._drain(proxy.POLL_INTERVAL)
+            except Exception:
+                LOG.exception("Draining events failed.")
+                self._closed.wait(proxy.POLL_INTERVAL)
+
+    def _make_stream(self, future):
+        return AsyncResultStream(future)
+
+    def close(self):
+        """Stop draining the responses."""
+        self._closed.set()
+        if self._drainer is not None:
+            self._drainer.join()
+
+    @property
+    def no_cache(self):
+        """Variant of the remote-method-coroutines which bypasses the result
+        cache of the method, see :attr:`Proxy.no_cache`.
+        """
+        return proxy._Dispatcher(functools.partial(self.__request,
+                                                   use_cache=False))
+
+    async def __request(self, func_name, func_args, func_kwargs,
+                        use_cache=True):
+        """The remote-method-call execution coroutine, the call timeout is
+        enforced by the event loop.
+
+        :param func_name: name of the method that should be executed
+        :param func_args: arguments for the remote-method
+        :param func_kwargs: keyword arguments for the remote-method
+        :param use_cache: return the cached result if there is one
+        :rtype: result of the method
+        """
+        self._ensure_drainer()
+        if self._has_uploads(func_args, func_kwargs):
+            # the upload waits for the server answering the first chunk
+            loop = asyncio.get_event_loop()
+            future = await loop.run_in_executor(None, functools.partial(
+                self._send_request, func_name, func_args, func_kwargs,
+                use_cache))
+        else:
+            future = self._send_request(func_name, func_args, func_kwargs,
+                                        use_cache)
+        timeout = self._timeout if self._timeout > 0 else None
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future),
+                                            timeout)
+        except asyncio.TimeoutError:
+            raise exc.RpcTimeout("RPC Request timeout")
+        finally:
+            # a late response for this call will be dropped, the chunks of
+            # a stream keep coming
+            if future.stream is None:
+                self._discard(future)
+        LOG.debug("Result: {!r}".format(result))
+        return result
+
+    def __getattr__(self, name):
+        """This method is invoked, if a method is being called, which doesn't
+        exist on AsyncProxy. It is used for RPC, to get the coroutine function
+        which should be called on the Server.
+        """
+        # magic method dispatcher
+        LOG.debug("Recursion: {0}".format(name))
+        return proxy._Method(self.__request, name)
+
+
+class AsyncResultStream(proxy.ResultStream):
+    """This class is the :class:`callme.proxy.ResultStream` of an
+    :class:`AsyncProxy` call, it is iterated with ``async for`` while the
+    chunks are fed by the thread draining the responses.
+
+    :param future: the :class:`callme.proxy.RpcFuture` of the call
+    """
+    def __init__(self, future):
+        super(AsyncResultStream, self).__init__(future)
+        self._lock = threading.Lock()
+        # the loop and the future of the coroutine waiting for an item
+        self._waiter = None
+
+    def feed(self, response):
+        with self._lock:
+            super(AsyncResultStream, self).feed(response)
+            waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            loop, future = waiter
+            loop.call_soon_threadsafe(_wake, future)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            with self._lock:
+                if self.done():
+                    break
+                loop = asyncio.get_event_loop()
+                future = loop.create_future()
+                self._waiter = loop, future
+            deadline = self.deadline
+            timeout = (max(deadline - time.time(), 0)
+                       if deadline is not None else None)
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                # fails the stream with `RpcTimeout` unless a chunk has
+                # extended the deadline meanwhile
+                self.expire(time.time())
+        try:
+            return next(self)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
@@ -29,26 +29,117 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import logging
+
 import kombu
+import kombu.serialization
+
+from callme import compression as cmp
+
+LOG = logging.getLogger(__name__)
+
+DIRECT_REPLY_TO = 'amq.rabbitmq.reply-to'
 
 
 class Base(object):
     """Base class for Proxy and Server."""
 
     def __init__(self, amqp_host, amqp_user, amqp_password, amqp_vhost,
-                 amqp_port, ssl):
+                 amqp_port, ssl, compression=None,
+                 compression_threshold=cmp.THRESHOLD,
+                 transport_options=None):
+        if compression is not None and not cmp.is_registered(compression):
+            raise ValueError("Unknown compression '{0}'.".format(compression))
         # create connection
-        self._conn = kombu.BrokerConnection(hostname=amqp_host,
-                                            userid=amqp_user,
-                                            password=amqp_password,
-                                            virtual_host=amqp_vhost,
-                                            port=amqp_port,
-                                            ssl=ssl)
+        self._conn = kombu.BrokerConnection(
+            hostname=amqp_host,
+            userid=amqp_user,
+            password=amqp_password,
+            virtual_host=amqp_vhost,
+            port=amqp_port,
+            ssl=ssl,
+            transport_options=transport_options)
+        if self._conn.transport.driver_name == 'py-amqp':
+            # a publish to a deleted exchange fails only with confirms
+            self._conn.transport_options.setdefault('confirm_publish', True)
+        self._confirm_publish = bool(
+            self._conn.transport_options.get('confirm_publish'))
+        # the declaration caches of the connections this instance used
+        self._declaration_caches = []
+        self._compression = compression
+        self._compression_threshold = compression_threshold
+
+    def _encode_body(self, body, serializer):
+        """Serialize the body, it is compressed if it is not smaller than the
+        compression threshold. The codec is flagged in the message headers
+        and the body is decompressed by kombu on receipt.
+
+        :rtype: dictionary of the body related `publish` keywords
+        """
+        content_type, content_encoding, data = kombu.serialization.dumps(
+            body, serializer=serializer)
+        kwargs = {'body': data,
+                  'content_type': content_type,
+                  'content_encoding': content_encoding}
+        if (self._compression is not None and
+                len(data) >= self._compression_threshold):
+            kwargs['compression'] = self._compression
+        return kwargs
+
+    def _declare(self, channel, entities):
+        """Declare the exchanges and queues once per connection.
+
+        The declarations are remembered by the connection of the channel,
+        kombu forgets them on reconnect so they are declared again then.
+        The broker deletes auto-deleted entities without notice (e.g. while a
+        server restarts), with publisher confirms the next publish fails and
+        `_publish` declares them again. Without confirms such a publish is
+        lost silently, so they are declared every time then.
+        """
+        declared = channel.connection.client.declared_entities
+        for entity in entities:
+            if entity.auto_delete and not self._confirm_publish:
+                LOG.debug("Declare {0!r}.".format(entity))
+                entity(channel).declare()
+                continue
+            ident = hash(entity)
+            if ident not in declared:
+                LOG.debug("Declare {0!r}.".format(entity))
+                entity(channel).declare()
+                declared.add(ident)
+                if not any(cache is declared
+                           for cache in self._declaration_caches):
+                    self._declaration_caches.append(declared)
+
+    def _forget_declarations(self):
+        """Declare the exchanges and queues again on next use."""
+        for cache in self._declaration_caches:
+            cache.clear()
+
+    def _publish(self, producer, declare=(), **kwargs):
+        """Publish a message, the entities in `declare` are declared first.
+
+        If the broker does not know an entity anymore (e.g. an auto-deleted
+        queue) the declarations are forgotten and the message is published
+        once again on a new channel.
+        """
+        try:
+            self._declare(producer.channel, declare)
+            producer.publish(**kwargs)
+        except producer.connection.channel_errors as e:
+            if getattr(e, 'code', None) != 404:
+                raise
+            LOG.warning("Entity not found ({0}), declare again.".format(e))
+            self._forget_declarations()
+            producer.revive(producer.connection.channel())
+            self._declare(producer.channel, declare)
+            producer.publish(**kwargs)
 
     @staticmethod
-    def _make_exchange(name, durable=False, auto_delete=True):
+    def _make_exchange(name, durable=False, auto_delete=True, type='direct'):
         """Make named exchange."""
         return kombu.Exchange(name=name,
+                              type=type,
                               durable=durable,
                               auto_delete=auto_delete)
 
@@ -0,0 +1,146 @@
+# Copyright (c) 2009-2014, Christian Haintz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+#     * Neither the name of callme nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import collections
+import threading
+import time
+
+MAXSIZE = 128
+
+# returned by `ResultCache.get` if there is no valid cached result
+MISS = object()
+
+
+class ResultCache(object):
+    """This class caches the results of a function by its arguments. The
+    least recently used results are evicted once the cache is full, and
+    results older than `ttl` seconds are not used anymore.
+
+    Typical use:
+
+        >> lookups = cache.ResultCache(maxsize=1000, ttl=60)
+        >> server.register_function(lookup, cache=lookups)
+        >> lookups.invalidate('key')
+
+    :param maxsize: the maximum number of cached results
+    :param ttl: the number of seconds a result is valid, forever by default
+    """
+    def __init__(self, maxsize=MAXSIZE, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._results = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._results)
+
+    def get(self, args, kwargs):
+        """Get the cached result of the call with the given arguments.
+
+        :rtype: the result or `MISS`
+        """
+        key = make_key(args, kwargs)
+        with self._lock:
+            try:
+                expires, result = self._results[key]
+            except (KeyError, TypeError):
+                self.misses += 1
+                return MISS
+            if expires is not None and expires <= time.time():
+                del self._results[key]
+                self.misses += 1
+                return MISS
+            # mark the result as the most recently used
+            del self._results[key]
+            self._results[key] = expires, result
+            self.hits += 1
+            return result
+
+    def put(self, args, kwargs, result):
+        """Cache the result of the call with the given arguments, the result
+        of arguments which can't be hashed is not cached.
+        """
+        key = make_key(args, kwargs)
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            try:
+                self._results.pop(key, None)
+            except TypeError:
+                return
+            self._results[key] = expires, result
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *args, **kwargs):
+        """Drop the cached result of the call with the given arguments."""
+        key = make_key(args, kwargs)
+        with self._lock:
+            try:
+                self._results.pop(key, None)
+            except TypeError:
+                pass
+
+    def clear(self):
+        """Drop all the cached results."""
+        with self._lock:
+            self._results.clear()
+
+    def stats(self):
+        """Return the counters of the cache.
+
+        :rtype: dictionary with the `hits`, `misses`, `evictions` and `size`
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'size': len(self._results)}
+
+
+def make_key(args, kwargs):
+    """Make the cache key of the given arguments. Lists and tuples are
+    equal, so arguments transported by json hit the same results.
+    """
+    return _freeze(args), _freeze(kwargs)
+
+
+def _freeze(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return frozenset((key, _freeze(item)) for key, item in value.items())
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
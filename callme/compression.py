@@ -0,0 +1,62 @@
+# Copyright (c) 2009-2014, Christian Haintz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+#     * Neither the name of callme nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import kombu.compression
+
+# bodies smaller than this number of bytes are sent uncompressed
+THRESHOLD = 1024
+
+
+def register(name, encoder, decoder):
+    """Register a compression codec so it can be used as `compression` of the
+    Proxy and the Server. The codec must be registered on both sides.
+
+    Typical use:
+
+        >> import bz2
+        >> compression.register('bz2', bz2.compress, bz2.decompress)
+
+    :param name: the name of the codec
+    :param encoder: function compressing bytes
+    :param decoder: function decompressing bytes
+    """
+    kombu.compression.register(encoder, decoder,
+                               'application/x-{0}'.format(name),
+                               aliases=[name])
+
+
+def is_registered(name):
+    """Return whether a codec with the given name is registered."""
+    try:
+        kombu.compression.get_encoder(name)
+    except KeyError:
+        return False
+    return True
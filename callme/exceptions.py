@@ -40,3 +40,25 @@ class ConnectionError(CallmeException):
 
 class RpcTimeout(CallmeException):
     """Raised when RPC request timed out."""
+
+
+class ServerBusy(CallmeException):
+    """Raised when the server rejected the RPC request because its backlog
+    is full.
+    """
+
+
+class RemoteError(CallmeException):
+    """Raised when an exception raised on the server can't be rebuilt by
+    the proxy.
+
+    :param exc_type: the full name of the type of the remote exception
+    :param message: the message of the remote exception
+    """
+    def __init__(self, exc_type, message):
+        super(RemoteError, self).__init__(exc_type, message)
+        self.exc_type = exc_type
+        self.message = message
+
+    def __str__(self):
+        return "{0}: {1}".format(self.exc_type, self.message)
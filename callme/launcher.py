@@ -0,0 +1,269 @@
+# Copyright (c) 2009-2014, Christian Haintz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+#     * Neither the name of callme nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""The ``callme-server`` command runs a server in several worker processes,
+each one running a :class:`callme.Server` with the same server id, and
+supervises them.
+
+Usage::
+
+    $ callme-server --server-id fooserver --workers 4 --threads 10 \
+          examples.server:add examples.server:fib
+"""
+
+import argparse
+import importlib
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from callme import server as srv
+
+LOG = logging.getLogger(__name__)
+
+SUPERVISE_INTERVAL = 1
+# a worker process is restarted at most once per this number of seconds
+RESTART_DELAY = 1
+# seconds the workers get to finish their requests on shutdown
+STOP_TIMEOUT = 10
+MEMORY_CHECK_INTERVAL = 5
+
+
+def load_function(spec):
+    """Load the function of a `module:attr` spec, the attribute may be
+    dotted (e.g. `module:Class.method`).
+
+    :rtype: tuple of the name of the attribute and the function
+    :raises: ValueError if the spec is invalid or not callable
+    """
+    module_name, _, attr = spec.partition(':')
+    if not module_name or not attr:
+        raise ValueError("The '{0}' function spec is not of the form "
+                         "module:attr.".format(spec))
+    func = importlib.import_module(module_name)
+    for name in attr.split('.'):
+        func = getattr(func, name)
+    if not callable(func):
+        raise ValueError("The '{0}' is not callable.".format(spec))
+    return attr, func
+
+
+def max_rss():
+    """Return the peak resident memory of this process in bytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on OS X
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def run_worker(server_kwargs, func_specs, memory_limit=None):
+    """Run a server in this worker process until it is stopped by SIGTERM
+    or exceeds the memory limit.
+
+    :param server_kwargs: the keywords of the :class:`callme.Server`
+    :param func_specs: the `module:attr` specs of the functions
+    :param memory_limit: stop the server once the process used more than
+        this number of bytes, the supervisor starts a new worker
+    """
+    # the supervisor stops the workers on SIGINT
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server = srv.Server(**server_kwargs)
+    for spec in func_specs:
+        name, func = load_function(spec)
+        server.register_function(func, name)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+
+    if memory_limit is not None and resource is not None:
+        watcher = threading.Thread(target=_watch_memory,
+                                   args=(server, memory_limit))
+        watcher.daemon = True
+        watcher.start()
+    server.start()
+
+
+def _watch_memory(server, memory_limit):
+    server.wait()
+    while server.is_running:
+        if max_rss() > memory_limit:
+            LOG.warning("Worker exceeded the memory limit of {0} bytes, "
+                        "stopping.".format(memory_limit))
+            server.stop()
+            return
+        time.sleep(MEMORY_CHECK_INTERVAL)
+
+
+class Launcher(object):
+    """This class starts the worker processes and supervises them: a worker
+    which exits is restarted until the launcher is stopped, stopping sends
+    SIGTERM to the workers so they finish their requests.
+
+    :param server_kwargs: the keywords of the :class:`callme.Server` of the
+        workers
+    :param func_specs: the `module:attr` specs of the functions to register
+    :param workers: the number of worker processes
+    :param memory_limit: the number of bytes a worker may use before it is
+        replaced by a new one
+    """
+
+    def __init__(self, server_kwargs, func_specs, workers, memory_limit=None):
+        self._server_kwargs = server_kwargs
+        self._func_specs = func_specs
+        self._workers = [None] * workers
+        self._started = [0.0] * workers
+        self._memory_limit = memory_limit
+        self._stopped = threading.Event()
+
+    def _start_worker(self, slot):
+        process = multiprocessing.Process(
+            target=run_worker,
+            args=(self._server_kwargs, self._func_specs, self._memory_limit))
+        process.daemon = False
+        process.start()
+        LOG.info("Started worker {0} (pid {1}).".format(slot, process.pid))
+        self._workers[slot] = process
+        self._started[slot] = time.time()
+
+    def _supervise(self):
+        """Restart the workers which exited."""
+        for slot, process in enumerate(self._workers):
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                LOG.warning("Worker {0} (pid {1}) exited with code {2}."
+                            .format(slot, process.pid, process.exitcode))
+            if time.time() - self._started[slot] >= RESTART_DELAY:
+                self._start_worker(slot)
+
+    def run(self):
+        """Start the workers and supervise them until the launcher is
+        stopped.
+        """
+        for spec in self._func_specs:
+            # fail before starting any worker
+            load_function(spec)
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stop())
+        try:
+            while not self._stopped.is_set():
+                self._supervise()
+                self._stopped.wait(SUPERVISE_INTERVAL)
+        finally:
+            self._stop_workers()
+
+    def stop(self):
+        """Stop supervising, the workers are stopped by :meth:`run`."""
+        self._stopped.set()
+
+    def _stop_workers(self):
+        processes = [p for p in self._workers if p is not None]
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.time() + STOP_TIMEOUT
+        for process in processes:
+            process.join(max(deadline - time.time(), 0))
+            if process.is_alive():
+                LOG.warning("Worker (pid {0}) didn't stop in time, killing."
+                            .format(process.pid))
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+
+
+def parse_args(argv=None):
+    """Parse the command line.
+
+    :rtype: tuple of the keywords of the servers and the parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        prog='callme-server',
+        description="Run a callme server in several worker processes.")
+    parser.add_argument('functions', nargs='+', metavar='module:attr',
+                        help="the functions to register")
+    parser.add_argument('--server-id', required=True)
+    parser.add_argument('--amqp-host', default='localhost')
+    parser.add_argument('--amqp-port', type=int, default=5672)
+    parser.add_argument('--amqp-user', default='guest')
+    parser.add_argument('--amqp-password', default='guest')
+    parser.add_argument('--amqp-vhost', default='/')
+    parser.add_argument('--ssl', action='store_true')
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="number of worker processes (default: number "
+                             "of CPUs)")
+    parser.add_argument('--threads', type=int, default=0,
+                        help="number of threads per worker process, 0 runs "
+                             "the calls in the consumer thread (default: 0)")
+    parser.add_argument('--prefetch-count', type=int)
+    parser.add_argument('--ack-late', action='store_true')
+    parser.add_argument('--memory-limit', type=int, metavar='MB',
+                        help="replace a worker once it used more memory")
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args(argv)
+
+    server_kwargs = {'server_id': args.server_id,
+                     'amqp_host': args.amqp_host,
+                     'amqp_port': args.amqp_port,
+                     'amqp_user': args.amqp_user,
+                     'amqp_password': args.amqp_password,
+                     'amqp_vhost': args.amqp_vhost,
+                     'ssl': args.ssl,
+                     'threaded': args.threads > 0,
+                     'prefetch_count': args.prefetch_count,
+                     'ack_late': args.ack_late}
+    if args.threads > 0:
+        server_kwargs['max_workers'] = args.threads
+    return server_kwargs, args
+
+
+def main(argv=None):
+    """The entry point of the ``callme-server`` command."""
+    server_kwargs, args = parse_args(argv)
+    logging.basicConfig(
+        level=args.log_level.upper(),
+        format="%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s")
+    memory_limit = None
+    if args.memory_limit is not None:
+        memory_limit = args.memory_limit * 1024 * 1024
+    launcher = Launcher(server_kwargs, args.functions, args.workers,
+                        memory_limit)
+    launcher.run()
+
+
+if __name__ == '__main__':
+    main()
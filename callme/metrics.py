@@ -0,0 +1,221 @@
+# Copyright (c) 2009-2014, Christian Haintz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+#     * Neither the name of callme nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import bisect
+import collections
+import threading
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0)
+
+# the function name of batch requests
+BATCH = '<batch>'
+
+
+class MetricsHook(object):
+    """This class is the interface of the metrics hook of the server, all
+    the methods do nothing. Subclass it to forward the metrics to another
+    system, the methods are called from the consumer and the worker threads.
+    """
+
+    def observe_decode(self, func_name, seconds):
+        """Record the deserialization time of a request."""
+
+    def observe_execution(self, func_name, seconds, error):
+        """Record the execution time of a function and whether it raised an
+        exception.
+        """
+
+    def observe_publish(self, func_name, seconds):
+        """Record the publish time of a response."""
+
+    def observe_expired(self, func_name):
+        """Record a request dropped because its deadline has passed."""
+
+    def set_in_flight(self, count):
+        """Set the number of requests being executed."""
+
+    def set_backlog(self, count):
+        """Set the number of requests waiting for a worker thread."""
+
+
+class Histogram(object):
+    """This class counts the observed values per bucket.
+
+    :param buckets: the sorted upper bounds of the buckets
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Return the cumulative counts per upper bound, the last bound is
+        infinite.
+
+        :rtype: list of tuples of the upper bound and the count
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),),
+                                self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics(MetricsHook):
+    """This class records the metrics per function in memory, :meth:`dump`
+    returns them in the Prometheus text format.
+
+    Typical use:
+
+        >> server = callme.Server('fooserver', metrics=metrics.Metrics())
+        >> print(server.metrics.dump())
+
+    :param prefix: the prefix of the metric names
+    :param buckets: the upper bounds in seconds of the histogram buckets
+    """
+    def __init__(self, prefix='callme', buckets=BUCKETS):
+        self.prefix = prefix
+        self.calls = collections.defaultdict(int)
+        self.errors = collections.defaultdict(int)
+        self.expired = collections.defaultdict(int)
+        self.execution = collections.defaultdict(
+            lambda: Histogram(buckets))
+        self.decode = collections.defaultdict(lambda: Histogram(buckets))
+        self.publish = collections.defaultdict(lambda: Histogram(buckets))
+        self.in_flight = 0
+        self.backlog = 0
+        self._lock = threading.Lock()
+
+    def observe_decode(self, func_name, seconds):
+        with self._lock:
+            self.decode[func_name].observe(seconds)
+
+    def observe_execution(self, func_name, seconds, error):
+        with self._lock:
+            self.calls[func_name] += 1
+            self.errors[func_name] += 1 if error else 0
+            self.execution[func_name].observe(seconds)
+
+    def observe_publish(self, func_name, seconds):
+        with self._lock:
+            self.publish[func_name].observe(seconds)
+
+    def observe_expired(self, func_name):
+        with self._lock:
+            self.expired[func_name] += 1
+
+    def set_in_flight(self, count):
+        self.in_flight = count
+
+    def set_backlog(self, count):
+        self.backlog = count
+
+    def dump(self):
+        """Dump the metrics in the Prometheus text format.
+
+        :rtype: string
+        """
+        lines = []
+        with self._lock:
+            self._dump_counter(lines, 'calls_total',
+                               "Number of executed calls.", self.calls)
+            self._dump_counter(lines, 'errors_total',
+                               "Number of calls which raised an exception.",
+                               self.errors)
+            self._dump_counter(lines, 'expired_total',
+                               "Number of requests dropped after their "
+                               "deadline.", self.expired)
+            self._dump_histogram(lines, 'execution_seconds',
+                                 "Execution time of the functions.",
+                                 self.execution)
+            self._dump_histogram(lines, 'decode_seconds',
+                                 "Deserialization time of the requests.",
+                                 self.decode)
+            self._dump_histogram(lines, 'publish_seconds',
+                                 "Publish time of the responses.",
+                                 self.publish)
+            self._dump_gauge(lines, 'in_flight',
+                             "Number of requests being executed.",
+                             self.in_flight)
+            self._dump_gauge(lines, 'backlog',
+                             "Number of requests waiting for a worker.",
+                             self.backlog)
+        return '\n'.join(lines) + '\n'
+
+    def _header(self, lines, name, help_, type_):
+        name = '{0}_{1}'.format(self.prefix, name)
+        lines.append('# HELP {0} {1}'.format(name, help_))
+        lines.append('# TYPE {0} {1}'.format(name, type_))
+        return name
+
+    def _dump_counter(self, lines, name, help_, values):
+        name = self._header(lines, name, help_, 'counter')
+        for func_name, value in sorted(values.items()):
+            lines.append('{0}{{function="{1}"}} {2}'.format(
+                name, _escape(func_name), value))
+
+    def _dump_histogram(self, lines, name, help_, histograms):
+        name = self._header(lines, name, help_, 'histogram')
+        for func_name, histogram in sorted(histograms.items()):
+            label = _escape(func_name)
+            for bound, count in histogram.cumulative():
+                lines.append('{0}_bucket{{function="{1}",le="{2}"}} {3}'
+                             .format(name, label, _format_bound(bound),
+                                     count))
+            lines.append('{0}_sum{{function="{1}"}} {2!r}'.format(
+                name, label, histogram.sum))
+            lines.append('{0}_count{{function="{1}"}} {2}'.format(
+                name, label, histogram.count))
+
+    def _dump_gauge(self, lines, name, help_, value):
+        name = self._header(lines, name, help_, 'gauge')
+        lines.append('{0} {1}'.format(name, value))
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_bound(bound):
+    if bound == float('inf'):
+        return '+Inf'
+    return repr(float(bound))
@@ -0,0 +1,117 @@
+# Copyright (c) 2009-2014, Christian Haintz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+#     * Neither the name of callme nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import cProfile
+import pstats
+import threading
+import time
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+# name of the built-in function profiling the requests of a server
+FUNCTION = '__callme_profile__'
+SECONDS = 10
+LIMIT = 30
+
+
+class Session(object):
+    """This class profiles the executions of the requests with `cProfile`
+    and aggregates their stats, until the given number of calls has been
+    profiled or the session is stopped.
+
+    :param calls: the number of calls to profile or None
+    """
+    def __init__(self, calls=None):
+        self.calls = 0
+        self._max_calls = calls
+        self._stats = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._started = time.time()
+        self._stopped = None
+
+    def run(self, func, *args, **kwargs):
+        """Call the function under the profiler."""
+        if self._done.is_set():
+            return func(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is active, since Python 3.12 only one
+            # profiler can be active per process
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            self._add(profile)
+
+    def _add(self, profile):
+        with self._lock:
+            if self._done.is_set():
+                return
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self.calls += 1
+            if self._max_calls is not None and self.calls >= self._max_calls:
+                self._done.set()
+
+    def wait(self, seconds):
+        """Profile for at most the given number of seconds, then stop the
+        session.
+        """
+        self._done.wait(seconds)
+        with self._lock:
+            self._done.set()
+            self._stopped = time.time()
+
+    def report(self, sort='cumulative', limit=LIMIT):
+        """Get the aggregated stats of the profiled calls.
+
+        :param sort: the key the functions are sorted by, see
+            :meth:`pstats.Stats.sort_stats`
+        :param limit: the number of functions reported
+        :rtype: dict with the number of profiled `calls`, the `seconds` the
+            session lasted and the `report` of the stats as text
+        """
+        stream = StringIO()
+        if self._stats is not None:
+            self._stats.stream = stream
+            self._stats.sort_stats(sort).print_stats(limit)
+        return {'calls': self.calls,
+                'seconds': (self._stopped or time.time()) - self._started,
+                'report': stream.getvalue()}
@@ -29,6 +29,40 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+from callme import exceptions as exc
+
+PICKLE = 'pickle'
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+# serializers accepted by the proxy and the server
+SERIALIZERS = (PICKLE, JSON, MSGPACK)
+
+_SCALAR_TYPES = (type(None), bool, int, float, str, type(u''))
+
+# AMQP `type` property of the messages carrying a chunk of an upload
+UPLOAD_CHUNK = 'callme.upload_chunk'
+
+# the only key of the dictionaries taking the place of uploaded arguments in
+# the json and msgpack requests, user data doesn't use it
+UPLOAD_KEY = '__callme_upload__'
+
+# message headers with the timestamps of a call, the proxy stamps the time the
+# request is sent, the server the times the request is received and executed
+SENT = 'callme-sent'
+RECEIVED = 'callme-received'
+STARTED = 'callme-started'
+FINISHED = 'callme-finished'
+
+# message header with the time after which the caller doesn't wait for the
+# response anymore, the server drops the request then
+DEADLINE = 'callme-deadline'
+
 
 class RpcRequest(object):
     """This class is used to transport the RPC Request to the server.
@@ -46,6 +80,47 @@ class RpcRequest(object):
         return ("<RpcRequest(func_name={0}, func_args={1}, func_kwargs={2})>"
                 .format(self.func_name, self.func_args, self.func_kwargs))
 
+    def to_dict(self):
+        return {'type': 'request',
+                'func_name': self.func_name,
+                'func_args': [_dump_arg(arg) for arg in self.func_args],
+                'func_kwargs': dict((key, _dump_arg(arg)) for key, arg
+                                    in self.func_kwargs.items())}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['func_name'],
+                   [_load_arg(arg) for arg in data['func_args']],
+                   dict((key, _load_arg(arg)) for key, arg
+                        in data['func_kwargs'].items()))
+
+
+class RpcUpload(object):
+    """This class takes the place of an argument uploaded to the server in
+    chunks ahead of the request.
+
+    :keyword upload_id: the id of the upload, sent as the `message_id` of the
+        chunk messages
+    :keyword binary: pass the argument to the function as bytes, otherwise as
+        a file object
+    """
+    def __init__(self, upload_id, binary):
+        self.upload_id = upload_id
+        self.binary = binary
+
+    def __str__(self):
+        return "<RpcUpload(upload_id={0}, binary={1})>".format(
+            self.upload_id, self.binary)
+
+    def to_dict(self):
+        return {'type': 'upload',
+                'upload_id': self.upload_id,
+                'binary': self.binary}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['upload_id'], data['binary'])
+
 
 class RpcResponse(object):
     """This class is used to transport the RPC Response to the client.
@@ -61,3 +136,165 @@ class RpcResponse(object):
     @property
     def is_exception(self):
         return isinstance(self.result, BaseException)
+
+    def to_dict(self):
+        if self.is_exception:
+            return {'type': 'response',
+                    'exception': dump_exception(self.result)}
+        return {'type': 'response', 'result': self.result}
+
+    @classmethod
+    def from_dict(cls, data):
+        if 'exception' in data:
+            return cls(load_exception(data['exception']))
+        return cls(data['result'])
+
+
+class RpcBatchRequest(object):
+    """This class is used to transport several RPC Requests to the server in
+    one message.
+
+    :keyword requests: list of `RpcRequest`
+    """
+    def __init__(self, requests):
+        self.requests = requests
+
+    def __str__(self):
+        return "<RpcBatchRequest(requests=[{0}])>".format(
+            ', '.join(str(request) for request in self.requests))
+
+    def to_dict(self):
+        return {'type': 'batch_request',
+                'requests': [request.to_dict() for request in self.requests]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls([RpcRequest.from_dict(request)
+                    for request in data['requests']])
+
+
+class RpcBatchResponse(object):
+    """This class is used to transport the RPC Responses of a batch request
+    to the client in one message.
+
+    :keyword responses: list of `RpcResponse` in the order of the requests
+    """
+    def __init__(self, responses):
+        self.responses = responses
+
+    def __str__(self):
+        return "<RpcBatchResponse(responses=[{0}])>".format(
+            ', '.join(str(response) for response in self.responses))
+
+    def to_dict(self):
+        return {'type': 'batch_response',
+                'responses': [response.to_dict()
+                              for response in self.responses]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls([RpcResponse.from_dict(response)
+                    for response in data['responses']])
+
+
+class RpcStreamChunk(object):
+    """This class is used to transport a chunk of the items yielded by a
+    generator function to the client. The chunks of a stream share the
+    correlation id of the request, the last chunk is marked with `end`.
+
+    :keyword items: list of items in the order they were yielded
+    :keyword end: True if this is the last chunk of the stream
+    """
+    def __init__(self, items, end=False):
+        self.items = items
+        self.end = end
+
+    def __str__(self):
+        return "<RpcStreamChunk(items={0}, end={1})>".format(self.items,
+                                                             self.end)
+
+    def to_dict(self):
+        return {'type': 'stream_chunk',
+                'items': list(self.items),
+                'end': self.end}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['items'], data['end'])
+
+
+_MESSAGE_TYPES = {
+    'request': RpcRequest,
+    'response': RpcResponse,
+    'batch_request': RpcBatchRequest,
+    'batch_response': RpcBatchResponse,
+    'stream_chunk': RpcStreamChunk,
+}
+
+
+def encode(message, serializer):
+    """Encode the message into the body of an AMQP message. With pickle the
+    instances are transported as they are, with the other serializers they
+    are transported as dictionaries.
+
+    :param message: the request or response instance
+    :param serializer: the name of the kombu serializer
+    """
+    if serializer == PICKLE:
+        return message
+    return message.to_dict()
+
+
+def decode(body):
+    """Decode the body of an AMQP message already deserialized by kombu.
+
+    :rtype: the request or response instance, an unknown body is returned as
+        it is
+    """
+    if isinstance(body, dict):
+        try:
+            return _MESSAGE_TYPES[body['type']].from_dict(body)
+        except (KeyError, TypeError):
+            return body
+    return body
+
+
+def _dump_arg(arg):
+    if isinstance(arg, RpcUpload):
+        return {UPLOAD_KEY: arg.to_dict()}
+    return arg
+
+
+def _load_arg(arg):
+    if isinstance(arg, dict) and len(arg) == 1 and UPLOAD_KEY in arg:
+        return RpcUpload.from_dict(arg[UPLOAD_KEY])
+    return arg
+
+
+def dump_exception(e):
+    """Dump the exception into a dictionary."""
+    args = list(e.args)
+    if not all(isinstance(arg, _SCALAR_TYPES) for arg in args):
+        args = [str(e)]
+    return {'type': '{0}.{1}'.format(type(e).__module__, type(e).__name__),
+            'args': args,
+            'message': str(e)}
+
+
+def load_exception(data):
+    """Load the exception from a dictionary. Builtin and callme exceptions
+    are rebuilt, any other exception is loaded as `RemoteError`.
+    """
+    module, _, name = data['type'].rpartition('.')
+    if module in ('builtins', 'exceptions'):
+        cls = getattr(builtins, name, None)
+    elif module == exc.__name__:
+        cls = getattr(exc, name, None)
+    else:
+        cls = None
+    if isinstance(cls, type) and issubclass(cls, BaseException):
+        try:
+            return cls(*data['args'])
+        except Exception:
+            pass
+    return exc.RemoteError(data['type'], data['message'])
@@ -29,20 +29,29 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import collections
+import functools
 import logging
 import socket
+import threading
 import time
 import uuid
 
+from concurrent import futures
 import kombu
 
 from callme import base
+from callme import cache as cache_
+from callme import compression as cmp
 from callme import exceptions as exc
 from callme import protocol as pr
 
 LOG = logging.getLogger(__name__)
 
 REQUEST_TIMEOUT = 60
+POLL_INTERVAL = 1
+COALESCE_MAX = 100
+BROADCAST_TIMEOUT = 5
 
 
 class Proxy(base.Base):
@@ -61,6 +70,26 @@ class Proxy(base.Base):
     :keyword durable: make all exchanges and queues durable
     :keyword auto_delete: delete server queues after all connections are closed
         not applicable for client queues
+    :keyword direct_reply_to: receive the responses through the RabbitMQ
+        direct reply-to pseudo queue instead of an own exchange and queue
+    :keyword serializer: serializer of the requests, `pickle`, `json` or
+        `msgpack`, the server responds with the same serializer
+    :keyword compression: codec compressing large requests, e.g. `zlib` or
+        `lzma` (see :mod:`callme.compression`)
+    :keyword compression_threshold: requests smaller than this number of bytes
+        are not compressed
+    :keyword coalesce_window: buffer the calls for this number of seconds and
+        send them as one batch, off by default
+    :keyword coalesce_max: send the buffered calls as soon as there are this
+        many of them
+    :keyword upload_chunk_size: upload bytes arguments larger than this
+        number of bytes and file-like arguments to the server in chunks of
+        this size ahead of the call, off by default
+    :keyword transport_options: options of the kombu transport, e.g. the
+        `polling_interval` of the in-memory transport, publisher confirms
+        (`confirm_publish`) are on by default with py-amqp
+    :keyword call_info_callback: called with the :class:`CallInfo` of every
+        response from the thread receiving it, it must not block
     """
 
     def __init__(self,
@@ -73,36 +102,69 @@ class Proxy(base.Base):
                  ssl=False,
                  timeout=REQUEST_TIMEOUT,
                  durable=False,
-                 auto_delete=True):
+                 auto_delete=True,
+                 direct_reply_to=False,
+                 serializer=pr.PICKLE,
+                 compression=None,
+                 compression_threshold=cmp.THRESHOLD,
+                 coalesce_window=None,
+                 coalesce_max=COALESCE_MAX,
+                 upload_chunk_size=None,
+                 transport_options=None,
+                 call_info_callback=None):
 
         super(Proxy, self).__init__(amqp_host, amqp_user, amqp_password,
-                                    amqp_vhost, amqp_port, ssl)
+                                    amqp_vhost, amqp_port, ssl,
+                                    compression, compression_threshold,
+                                    transport_options)
         self._uuid = str(uuid.uuid4())
         self._server_id = server_id
         self._timeout = timeout
-        self._is_received = False
-        self._corr_id = None
-        self._response = None
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._drain_cond = threading.Condition()
+        self._draining = False
         self._exchange_name = 'client_{0}_ex_{1}'.format(amqp_user, self._uuid)
         self._queue_name = 'client_{0}_queue_{1}'.format(amqp_user, self._uuid)
         self._durable = durable
         self._auto_delete = auto_delete
+        self._server_entities = {}
+        self._direct_reply_to = direct_reply_to
+        self._serializer = serializer
+        self._upload_chunk_size = upload_chunk_size
+        self._caches = {}
+        self._call_info_callback = call_info_callback
+        self._coalescer = None
+        if coalesce_window is not None:
+            self._coalescer = _Coalescer(self, coalesce_window, coalesce_max)
 
-        # create exchange
-        exchange = self._make_exchange(self._exchange_name,
-                                       durable=self._durable,
-                                       auto_delete=True)
+        if direct_reply_to:
+            # nothing to declare, the requests must be published on the
+            # channel consuming from the pseudo queue
+            self._reply_to = base.DIRECT_REPLY_TO
+            queue = kombu.Queue(base.DIRECT_REPLY_TO, no_ack=True)
+            self._producer = kombu.Producer(self._conn)
+            self._publish_lock = threading.Lock()
+        else:
+            self._reply_to = self._exchange_name
+
+            # create exchange
+            exchange = self._make_exchange(self._exchange_name,
+                                           durable=self._durable,
+                                           auto_delete=True)
 
-        # create queue
-        queue = self._make_queue(self._queue_name, exchange,
-                                 durable=self._durable,
-                                 auto_delete=True)
+            # create queue
+            queue = self._make_queue(self._queue_name, exchange,
+                                     durable=self._durable,
+                                     auto_delete=True)
 
         # create consumer
         consumer = kombu.Consumer(channel=self._conn,
                                   queues=queue,
                                   callbacks=[self._on_response],
-                                  accept=['pickle'])
+                                  accept=list(pr.SERIALIZERS),
+                                  no_ack=direct_reply_to,
+                                  auto_declare=not direct_reply_to)
         consumer.consume()
 
     def use_server(self, server_id=None, timeout=None):
@@ -133,6 +195,7 @@ class Proxy(base.Base):
         :param message: the plain amqp kombu.message with additional
             information
         """
+        replied = time.time()
         LOG.debug("Got response: {0}".format(response))
         try:
             message.ack()
@@ -142,73 +205,497 @@ class Proxy(base.Base):
             LOG.debug("AMQP message acknowledged.")
 
             # check response type
-            if not isinstance(response, pr.RpcResponse):
-                LOG.warning("Response is not a `RpcResponse` instance.")
+            response = pr.decode(response)
+            if not isinstance(response, (pr.RpcResponse,
+                                         pr.RpcBatchResponse,
+                                         pr.RpcStreamChunk)):
+                LOG.warning("Response is not a `RpcResponse`, "
+                            "`RpcBatchResponse` or `RpcStreamChunk` "
+                            "instance.")
                 return
 
             # process response
             try:
-                if self._corr_id == message.properties['correlation_id']:
-                    self._response = response
-                    self._is_received = True
+                corr_id = message.properties['correlation_id']
             except KeyError:
                 LOG.error("Message has no `correlation_id` property.")
+                return
+
+            with self._pending_lock:
+                future = self._pending.get(corr_id)
+                if future is not None and future.is_last(response):
+                    del self._pending[corr_id]
+            if future is None:
+                LOG.warning("No pending call with correlation id {0}, "
+                            "response dropped.".format(corr_id))
+                return
+            call_info = CallInfo.from_headers(message.headers, corr_id,
+                                              replied)
+            if (call_info is not None and
+                    self._call_info_callback is not None):
+                try:
+                    self._call_info_callback(call_info)
+                except Exception:
+                    LOG.exception("Call info callback failed.")
+            future.set_response(response, call_info)
+
+    @property
+    def call_async(self):
+        """Non-blocking variant of the remote-method-calls. The call returns
+        a :class:`RpcFuture` right after the request has been published.
+
+        Typical use:
+
+            >> future = my_proxy.call_async.a_remote_func()
+            >> future.result()
+
+        :rtype: dispatcher for the remote-methods
+        """
+        return _Dispatcher(self._send_request)
+
+    @property
+    def no_cache(self):
+        """Variant of the remote-method-calls which bypasses the result cache
+        of the method (see :meth:`set_cache`), the fresh result is cached.
+
+        Typical use:
+
+            >> my_proxy.no_cache.config.get('key')
+
+        :rtype: dispatcher for the remote-methods
+        """
+        return _Dispatcher(functools.partial(self.__request, use_cache=False))
+
+    def set_cache(self, name, cache):
+        """Cache the results of the remote-method locally by its arguments,
+        cached results are returned without a call to the server. The cached
+        results are shared by the callers and must not be modified.
+
+        Typical use:
+
+            >> my_proxy.set_cache('config.get', cache.ResultCache(ttl=60))
+
+        :param name: the dotted name of the remote-method
+        :param cache: a :class:`callme.cache.ResultCache`, None stops caching
+        """
+        if cache is not None:
+            self._caches[name] = cache
+        else:
+            self._caches.pop(name, None)
 
-    def __request(self, func_name, func_args, func_kwargs):
+    def get_cache(self, name):
+        """Return the result cache of the remote-method.
+
+        :param name: the dotted name of the remote-method
+        :rtype: :class:`callme.cache.ResultCache` or None
+        """
+        return self._caches.get(name)
+
+    def scatter(self, server_ids, timeout=None):
+        """Send the same remote-method-call to many servers at once and
+        gather their results, see :meth:`scatter_calls`.
+
+        Typical use:
+
+            >> results = my_proxy.scatter(['shard1', 'shard2']).count('foo')
+            >> results.results, results.errors
+
+        :param server_ids: the ids of the servers
+        :param timeout: the shared timeout in seconds, defaults to the call
+            timeout of the proxy
+        :rtype: dispatcher for the remote-methods returning
+            :class:`ScatterResults`
+        """
+        server_ids = list(server_ids)
+
+        def send(func_name, func_args, func_kwargs):
+            return self.scatter_calls(
+                dict((server_id, (func_name, func_args, func_kwargs))
+                     for server_id in server_ids), timeout)
+        return _Dispatcher(send)
+
+    def scatter_calls(self, calls, timeout=None):
+        """Send a remote-method-call per server at once and gather their
+        results until a shared deadline. A server failing or not responding
+        in time doesn't fail the others.
+
+        :param calls: dictionary of server id to the tuple of the dotted name
+            of the remote-method, its arguments and its keyword arguments
+        :param timeout: the shared timeout in seconds, defaults to the call
+            timeout of the proxy
+        :rtype: :class:`ScatterResults`
+        """
+        timeout = self._timeout if timeout is None else timeout
+        deadline = time.time() + timeout if timeout > 0 else None
+        pending = {}
+        errors = {}
+        for server_id, (func_name, func_args, func_kwargs) in calls.items():
+            request = pr.RpcRequest(func_name, func_args, func_kwargs)
+            try:
+                future = self._send(request, server_id, timeout=timeout)
+            except Exception as e:
+                LOG.exception("Failed to send the request to server {0}."
+                              .format(server_id))
+                errors[server_id] = e
+            else:
+                future.deadline = deadline
+                pending[server_id] = future
+
+        results = {}
+        for server_id, future in pending.items():
+            error = future.exception()
+            if error is None:
+                results[server_id] = future.result()
+            else:
+                errors[server_id] = error
+        return ScatterResults(results, errors)
+
+    def broadcast(self, timeout=BROADCAST_TIMEOUT, expected=None):
+        """Send the remote-method-call to every running instance of the
+        current server and collect their responses until the timeout expires
+        or the expected number of responses has arrived.
+
+        Typical use:
+
+            >> results = my_proxy.broadcast(timeout=2).invalidate('key')
+            >> len(results), results.results, results.errors
+
+        :param timeout: the number of seconds responses are collected, None
+            to wait for the expected number of responses only
+        :param expected: stop collecting once this number of responses has
+            arrived
+        :rtype: dispatcher for the remote-methods returning
+            :class:`BroadcastResults`
+        """
+        if timeout is None and expected is None:
+            raise ValueError("Either the timeout or the expected number of "
+                             "responses is required.")
+
+        def send(func_name, func_args, func_kwargs):
+            return self._broadcast(
+                pr.RpcRequest(func_name, func_args, func_kwargs),
+                timeout, expected)
+        return _Dispatcher(send)
+
+    def _broadcast(self, request, timeout, expected):
+        """Publish the request to the broadcast exchange of the current
+        server and collect the responses.
+
+        :rtype: :class:`BroadcastResults`
+        """
+        call = _BroadcastCall(self, str(uuid.uuid4()), timeout, expected)
+        with self._pending_lock:
+            self._pending[call.correlation_id] = call
+        LOG.debug("Broadcast request: {0}".format(request))
+
+        try:
+            exchange = self._make_exchange(
+                'server_{0}_broadcast_ex'.format(self._server_id),
+                durable=self._durable,
+                auto_delete=self._auto_delete,
+                type='fanout')
+            self._publish_request(declare=[exchange],
+                                  exchange=exchange,
+                                  correlation_id=call.correlation_id,
+                                  deadline=call.deadline,
+                                  **self._encode_body(
+                                      pr.encode(request, self._serializer),
+                                      self._serializer))
+        except Exception:
+            self._discard(call)
+            raise
+        self._wait_for_result(call)
+        return BroadcastResults(call.responses)
+
+    def start_batch(self):
+        """Start a batch of remote-method-calls which are sent to the server
+        in one message, see :class:`Batch`.
+
+        :rtype: :class:`Batch`
+        """
+        return Batch(self)
+
+    def __request(self, func_name, func_args, func_kwargs, use_cache=True):
         """The remote-method-call execution function.
 
         :param func_name: name of the method that should be executed
         :param func_args: arguments for the remote-method
         :param func_kwargs: keyword arguments for the remote-method
+        :param use_cache: return the cached result if there is one
         :type func_name: string
         :type func_args: list of parameters
         :rtype: result of the method
         """
-        self._corr_id = str(uuid.uuid4())
+        future = self._send_request(func_name, func_args, func_kwargs,
+                                    use_cache)
+        result = future.result()
+        LOG.debug("Result: {!r}".format(result))
+        return result
+
+    def _send_request(self, func_name, func_args, func_kwargs,
+                      use_cache=True):
+        """Publish the request and return a future for its result.
+
+        :param func_name: name of the method that should be executed
+        :param func_args: arguments for the remote-method
+        :param func_kwargs: keyword arguments for the remote-method
+        :param use_cache: return the cached result if there is one
+        :rtype: :class:`RpcFuture`
+        """
+        cache = self._caches.get(func_name)
+        if cache is not None and use_cache:
+            result = cache.get(func_args, func_kwargs)
+            if result is not cache_.MISS:
+                LOG.debug("Cached result: {!r}".format(result))
+                future = RpcFuture(self, None, 0)
+                future.set_response(pr.RpcResponse(result))
+                return future
+
         request = pr.RpcRequest(func_name, func_args, func_kwargs)
+        if self._has_uploads(func_args, func_kwargs):
+            future = self._send_with_uploads(request)
+        elif self._coalescer is not None:
+            future = self._coalescer.add(self._server_id, request)
+        else:
+            future = self._send(request)
+
+        if cache is not None:
+            future.add_done_callback(functools.partial(
+                self._put_cached, cache, func_args, func_kwargs))
+        return future
+
+    @staticmethod
+    def _put_cached(cache, func_args, func_kwargs, future):
+        """Cache the result of the done call, failures and streams are not
+        cached.
+        """
+        if future.cancelled() or future.exception() is not None:
+            return
+        result = future.result()
+        if not isinstance(result, ResultStream):
+            cache.put(func_args, func_kwargs, result)
+
+    def _has_uploads(self, func_args, func_kwargs):
+        """Return whether any of the arguments is uploaded in chunks."""
+        if self._upload_chunk_size is None:
+            return False
+        args = list(func_args) + list(func_kwargs.values())
+        return any(self._is_upload(arg) for arg in args)
+
+    def _is_upload(self, arg):
+        """Return whether the argument is uploaded in chunks."""
+        if isinstance(arg, (bytes, bytearray)):
+            return len(arg) > self._upload_chunk_size
+        return hasattr(arg, 'read')
+
+    def _send_with_uploads(self, request):
+        """Upload the large arguments of the request in chunks, then publish
+        the request referring to the uploads. The first chunk is answered by
+        the server instance which received it, the remaining chunks and the
+        request are routed to this instance.
+
+        :rtype: :class:`RpcFuture`
+        """
+        server_id = self._server_id
+        routing_key = None
+        args = list(request.func_args)
+        kwargs = dict(request.func_kwargs)
+        for container, keys in ((args, range(len(args))),
+                                (kwargs, list(kwargs))):
+            for key in keys:
+                arg = container[key]
+                if not self._is_upload(arg):
+                    continue
+                upload = pr.RpcUpload(str(uuid.uuid4()),
+                                      binary=not hasattr(arg, 'read'))
+                for data in self._iter_chunks(arg):
+                    routing_key = self._publish_chunk(upload, data, server_id,
+                                                      routing_key)
+                container[key] = upload
+        return self._send(pr.RpcRequest(request.func_name, args, kwargs),
+                          server_id, routing_key)
+
+    def _iter_chunks(self, source):
+        """Iterate the bytes or the file-like source in chunks, there is at
+        least one chunk.
+        """
+        size = self._upload_chunk_size
+        if not hasattr(source, 'read'):
+            for start in range(0, max(len(source), 1), size):
+                yield bytes(source[start:start + size])
+            return
+        data = source.read(size)
+        while True:
+            yield data
+            data = source.read(size)
+            if not data:
+                return
+
+    def _publish_chunk(self, upload, data, server_id, routing_key=None):
+        """Publish a chunk of the upload, without the routing key of a
+        server instance wait for the instance which receives the chunk.
+
+        :rtype: the routing key of the server instance
+        """
+        exchange, queue = self._get_server_entities(server_id)
+        kwargs = dict(exchange=exchange,
+                      body=data,
+                      content_type='application/data',
+                      content_encoding='binary',
+                      type=pr.UPLOAD_CHUNK,
+                      message_id=upload.upload_id)
+        if routing_key is not None:
+            self._publish_request(routing_key=routing_key, **kwargs)
+            return routing_key
+
+        future = self._make_future()
+        try:
+            self._publish_request(declare=[queue],
+                                  correlation_id=future.correlation_id,
+                                  **kwargs)
+        except Exception:
+            self._discard(future)
+            raise
+        return future.result()
+
+    def flush_calls(self):
+        """Send the calls buffered by the coalescing window right away."""
+        if self._coalescer is not None:
+            self._coalescer.flush()
+
+    def _send(self, request, server_id=None, routing_key=None, timeout=None):
+        """Publish the request or batch request and return a future for its
+        result, the result of a batch request is the list of `RpcResponse`.
+
+        :param server_id: the id of the server, defaults to the current one
+        :param routing_key: the routing key of a server instance, by default
+            any instance of the server receives the request
+        :param timeout: the call timeout in seconds sent as the deadline of
+            the request, defaults to the call timeout of the proxy
+        :rtype: :class:`RpcFuture`
+        """
+        future = self._make_future(timeout)
         LOG.debug("Publish request: {0}".format(request))
 
-        # publish request
-        with kombu.producers[self._conn].acquire(block=True) as producer:
+        try:
+            exchange, queue = self._get_server_entities(
+                server_id if server_id is not None else self._server_id)
+            self._publish_request(declare=[queue],
+                                  exchange=exchange,
+                                  routing_key=routing_key,
+                                  correlation_id=future.correlation_id,
+                                  deadline=future.deadline,
+                                  **self._encode_body(
+                                      pr.encode(request, self._serializer),
+                                      self._serializer))
+        except Exception:
+            self._discard(future)
+            raise
+        return future
+
+    def _publish_request(self, deadline=None, **kwargs):
+        """Publish a request whose response is sent to this proxy.
+
+        :param deadline: the time the call times out, the request expires in
+            the broker and the server drops it after this time
+        """
+        now = time.time()
+        kwargs['reply_to'] = self._reply_to
+        kwargs['headers'] = {pr.SENT: now}
+        if deadline is not None:
+            kwargs['headers'][pr.DEADLINE] = deadline
+            kwargs['expiration'] = max(deadline - now, 0.001)
+        if self._direct_reply_to:
+            with self._publish_lock:
+                self._publish(self._producer, **kwargs)
+        else:
+            with kombu.producers[self._conn].acquire(block=True) as producer:
+                self._publish(producer, **kwargs)
+
+    def _get_server_entities(self, server_id):
+        """Get the exchange and the queue of the given server."""
+        try:
+            return self._server_entities[server_id]
+        except KeyError:
             exchange = self._make_exchange(
-                'server_{0}_ex'.format(self._server_id),
+                'server_{0}_ex'.format(server_id),
                 durable=self._durable,
                 auto_delete=self._auto_delete)
             queue = self._make_queue(
-                'server_{0}_queue'.format(self._server_id), exchange,
+                'server_{0}_queue'.format(server_id), exchange,
                 durable=self._durable,
                 auto_delete=self._auto_delete)
-            producer.publish(body=request,
-                             serializer='pickle',
-                             exchange=exchange,
-                             reply_to=self._exchange_name,
-                             correlation_id=self._corr_id,
-                             declare=[queue])
-
-        # start waiting for the response
-        self._wait_for_result()
-        self._is_received = False
-
-        # handler response
-        result = self._response.result
-        LOG.debug("Result: {!r}".format(result))
-        if self._response.is_exception:
-            raise result
-        return result
+            self._server_entities[server_id] = exchange, queue
+            return exchange, queue
+
+    def _make_future(self, timeout=None):
+        """Make a future with a new correlation id and add it to the pending
+        calls.
 
-    def _wait_for_result(self):
-        """Waits for the result from the server, checks every second if
-        a timeout occurred. If a timeout occurred - the `RpcTimeout` exception
-        will be raised.
+        :param timeout: the call timeout, defaults to the one of the proxy
         """
-        start_time = time.time()
-        while not self._is_received:
-            try:
-                self._conn.drain_events(timeout=1)
-            except socket.timeout:
-                if self._timeout > 0:
-                    if time.time() - start_time > self._timeout:
-                        raise exc.RpcTimeout("RPC Request timeout")
+        future = RpcFuture(self, str(uuid.uuid4()),
+                           self._timeout if timeout is None else timeout)
+        with self._pending_lock:
+            self._pending[future.correlation_id] = future
+        return future
+
+    def _make_stream(self, future):
+        """Make the stream of the items of a generator function call.
+
+        :param future: the :class:`RpcFuture` of the call
+        """
+        return ResultStream(future)
+
+    def _discard(self, future):
+        """Remove the future from the pending calls, a late response for it
+        will be dropped.
+
+        :rtype: True if the future was still pending
+        """
+        with self._pending_lock:
+            return self._pending.pop(future.correlation_id, None) is not None
+
+    def _drain(self, timeout):
+        """Drain the incoming responses for at most `timeout` seconds.
+
+        Only one thread drains the reply queue at a time, the others wait
+        until the draining thread has dispatched the incoming responses to
+        their pending calls.
+        """
+        with self._drain_cond:
+            if self._draining:
+                self._drain_cond.wait(timeout)
+                return
+            self._draining = True
+        try:
+            self._conn.drain_events(timeout=timeout)
+        except socket.timeout:
+            pass
+        finally:
+            with self._drain_cond:
+                self._draining = False
+                self._drain_cond.notify_all()
+
+    def _wait_for_result(self, future, timeout=None):
+        """Waits for the result of the given future, checks at least every
+        second if a timeout occurred. If the call timeout occurred - the future
+        fails with the `RpcTimeout` exception.
+
+        :param future: the :class:`RpcFuture` to wait for
+        :param timeout: stop waiting after this number of seconds, the future
+            stays pending
+        """
+        wait_until = time.time() + timeout if timeout is not None else None
+        while not future.done():
+            now = time.time()
+            if future.expire(now):
+                return
+            until = min(t for t in (future.deadline, wait_until,
+                                    now + POLL_INTERVAL) if t is not None)
+            if until <= now:
+                return
+            self._drain(until - now)
 
     def __getattr__(self, name):
         """This method is invoked, if a method is being called, which doesn't
@@ -222,6 +709,557 @@ class Proxy(base.Base):
 # ===========================================================================
 
 
+class RpcFuture(futures.Future):
+    """This class is the future of a single in-flight call, it is resolved
+    by :meth:`Proxy._on_response` once the matching response arrives.
+
+    Waiting for the result drains the responses of the proxy which made the
+    call. If the call timeout of the proxy expires the future fails with the
+    `RpcTimeout` exception, if only the `timeout` passed to :meth:`result` or
+    :meth:`exception` expires `concurrent.futures.TimeoutError` is raised and
+    the call stays pending.
+
+    If the remote function is a generator function, the future is resolved
+    with a :class:`ResultStream` of its items as soon as the first chunk
+    arrives.
+
+    Once the response has arrived `call_info` holds the :class:`CallInfo`
+    with the timestamps of the call, if the server has sent them.
+
+    :param proxy: the proxy which made the call
+    :param correlation_id: the correlation id of the call
+    :param timeout: the call timeout in seconds
+    """
+    def __init__(self, proxy, correlation_id, timeout):
+        super(RpcFuture, self).__init__()
+        self._proxy = proxy
+        self._timeout = timeout
+        self.correlation_id = correlation_id
+        self.deadline = time.time() + timeout if timeout > 0 else None
+        self.stream = None
+        # the future of the batch carrying the call (see `_Coalescer`)
+        self.batch = None
+        self.call_info = None
+
+    def set_response(self, response, call_info=None):
+        """Resolve the future with the given `RpcResponse`, or with the list
+        of responses of the given `RpcBatchResponse`. Once the stream of a
+        generator function has started the responses are passed to it.
+
+        :param call_info: the :class:`CallInfo` of the response
+        """
+        if call_info is not None:
+            self.call_info = call_info
+        if self.stream is not None:
+            if (isinstance(response, pr.RpcStreamChunk) and
+                    self.deadline is not None):
+                # the call timeout applies to every chunk of the stream
+                self.deadline = time.time() + self._timeout
+            self.stream.feed(response)
+            return
+        if not self.set_running_or_notify_cancel():
+            self._proxy._discard(self)
+            return
+        if isinstance(response, pr.RpcStreamChunk):
+            self.stream = self._proxy._make_stream(self)
+            self.set_response(response)
+            self.set_result(self.stream)
+        elif isinstance(response, pr.RpcBatchResponse):
+            self.set_result(response.responses)
+        elif response.is_exception:
+            self.set_exception(response.result)
+        else:
+            self.set_result(response.result)
+
+    def is_last(self, response):
+        """Return whether the response completes the call, the call stays
+        pending until the end of a stream.
+        """
+        return not isinstance(response, pr.RpcStreamChunk) or response.end
+
+    def expire(self, now):
+        """Fail the future with `RpcTimeout` if its deadline has passed.
+
+        :rtype: True if the future has been expired
+        """
+        if self.batch is not None:
+            self.batch.expire(now)
+        if self.deadline is None or now < self.deadline:
+            return False
+        if not self._proxy._discard(self):
+            return False
+        # the server queue may be gone, declare it again on the next call
+        self._proxy._forget_declarations()
+        self.set_response(
+            pr.RpcResponse(exc.RpcTimeout("RPC Request timeout")))
+        return True
+
+    def result(self, timeout=None):
+        self._proxy._wait_for_result(self, timeout)
+        return super(RpcFuture, self).result(timeout=0)
+
+    def exception(self, timeout=None):
+        self._proxy._wait_for_result(self, timeout)
+        return super(RpcFuture, self).exception(timeout=0)
+
+
+class CallInfo(object):
+    """This class holds the timestamps of a call, which split its latency
+    into the time the request waited in the broker, in the backlog of the
+    server, the execution and the transit of the response.
+
+    The timestamps are taken from the clocks of the proxy and of the server,
+    `queued` and `transit` include the offset between the two clocks.
+
+    :param correlation_id: the correlation id of the call
+    :param sent: the time the proxy sent the request
+    :param received: the time the server received the request
+    :param started: the time the server started the execution
+    :param finished: the time the server finished the execution
+    :param replied: the time the proxy received the response
+    """
+    def __init__(self, correlation_id, sent, received, started, finished,
+                 replied):
+        self.correlation_id = correlation_id
+        self.sent = sent
+        self.received = received
+        self.started = started
+        self.finished = finished
+        self.replied = replied
+
+    def __str__(self):
+        return ("<CallInfo(queued={0:.6f}, backlog={1:.6f}, "
+                "execution={2:.6f}, transit={3:.6f})>".format(
+                    self.queued, self.backlog, self.execution, self.transit))
+
+    @classmethod
+    def from_headers(cls, headers, correlation_id, replied):
+        """Make the call info from the headers of a response.
+
+        :rtype: :class:`CallInfo` or None if a timestamp is missing
+        """
+        try:
+            return cls(correlation_id, headers[pr.SENT],
+                       headers[pr.RECEIVED], headers[pr.STARTED],
+                       headers[pr.FINISHED], replied)
+        except (KeyError, TypeError):
+            return None
+
+    @property
+    def queued(self):
+        """Seconds from sending the request until the server received it."""
+        return self.received - self.sent
+
+    @property
+    def backlog(self):
+        """Seconds the request waited for a worker of the server."""
+        return self.started - self.received
+
+    @property
+    def execution(self):
+        """Seconds the server executed the request."""
+        return self.finished - self.started
+
+    @property
+    def transit(self):
+        """Seconds from the end of the execution until the proxy received
+        the response.
+        """
+        return self.replied - self.finished
+
+    @property
+    def total(self):
+        """Seconds from sending the request until receiving the response."""
+        return self.replied - self.sent
+
+
+class _BroadcastCall(object):
+    """This class collects the responses of a broadcast call, it is pending
+    until the deadline or until the expected number of responses.
+
+    :param proxy: the proxy which made the call
+    :param correlation_id: the correlation id of the call
+    :param timeout: the number of seconds responses are collected or None
+    :param expected: the expected number of responses or None
+    """
+    def __init__(self, proxy, correlation_id, timeout, expected):
+        self._proxy = proxy
+        self._expected = expected
+        self._done = False
+        self.correlation_id = correlation_id
+        self.deadline = time.time() + timeout if timeout is not None else None
+        self.responses = []
+
+    def is_last(self, response):
+        return (self._expected is not None and
+                len(self.responses) + 1 >= self._expected)
+
+    def set_response(self, response, call_info=None):
+        self.responses.append(response)
+        if (self._expected is not None and
+                len(self.responses) >= self._expected):
+            self._done = True
+
+    def done(self):
+        return self._done
+
+    def expire(self, now):
+        if self.deadline is None or now < self.deadline:
+            return False
+        self._proxy._discard(self)
+        self._done = True
+        return True
+
+
+class ResultStream(object):
+    """This class is the iterator over the items yielded by a remote
+    generator function, the items are received in chunks while they are
+    iterated. An exception raised by the remote generator is raised once all
+    the items received before it have been iterated.
+
+    :param future: the :class:`RpcFuture` of the call
+    """
+    def __init__(self, future):
+        self._future = future
+        self._items = collections.deque()
+        self._error = None
+        self._ended = False
+
+    @property
+    def deadline(self):
+        return self._future.deadline
+
+    def feed(self, response):
+        """Add the items of the given `RpcStreamChunk` to the stream, or end
+        the stream with the exception of the given `RpcResponse`.
+        """
+        if isinstance(response, pr.RpcStreamChunk):
+            self._items.extend(response.items)
+            self._ended = response.end
+        else:
+            if response.is_exception:
+                self._error = response.result
+            self._ended = True
+
+    def done(self):
+        """Return whether an item is ready or the stream has ended."""
+        return bool(self._items) or self._ended
+
+    def expire(self, now):
+        return self._future.expire(now)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self._items:
+            if self._ended:
+                if self._error is not None:
+                    error, self._error = self._error, None
+                    raise error
+                raise StopIteration
+            self._future._proxy._wait_for_result(self)
+        return self._items.popleft()
+
+    next = __next__
+
+
+def gather(fs, timeout=None, return_exceptions=False):
+    """Wait for all the given futures and return their results in order.
+
+    :param fs: the futures to wait for
+    :param timeout: the shared timeout in seconds for all the futures
+    :param return_exceptions: return exceptions in place of the results
+        instead of raising the first one
+    :rtype: list of results
+    """
+    wait_until = time.time() + timeout if timeout is not None else None
+    results = []
+    for future in fs:
+        remaining = None
+        if wait_until is not None:
+            remaining = max(wait_until - time.time(), 0)
+        error = future.exception(timeout=remaining)
+        if error is None:
+            results.append(future.result(timeout=0))
+        elif return_exceptions:
+            results.append(error)
+        else:
+            raise error
+    return results
+
+
+def as_completed(fs, timeout=None):
+    """Yield the given futures as they complete.
+
+    :param fs: the futures to wait for
+    :param timeout: the shared timeout in seconds for all the futures
+    :raises: `concurrent.futures.TimeoutError` if the timeout expires
+    """
+    wait_until = time.time() + timeout if timeout is not None else None
+    pending = list(fs)
+    while pending:
+        now = time.time()
+        for future in pending:
+            if isinstance(future, RpcFuture):
+                future.expire(now)
+        done = [future for future in pending if future.done()]
+        for future in done:
+            pending.remove(future)
+            yield future
+        if not pending:
+            return
+        if wait_until is not None and time.time() >= wait_until:
+            raise futures.TimeoutError()
+
+        # drain the responses of every proxy with pending calls
+        proxies = []
+        for future in pending:
+            proxy = getattr(future, '_proxy', None)
+            if proxy is not None and proxy not in proxies:
+                proxies.append(proxy)
+        interval = POLL_INTERVAL / float(max(len(proxies), 1))
+        if wait_until is not None:
+            interval = max(min(interval, wait_until - time.time()), 0)
+        if proxies:
+            for proxy in proxies:
+                proxy._drain(interval)
+        else:
+            futures.wait(pending, timeout=interval,
+                         return_when=futures.FIRST_COMPLETED)
+
+# ===========================================================================
+
+
+class _Coalescer(object):
+    """This class buffers the calls of a proxy for a short window and sends
+    them as one batch per server. Every call keeps its own future, which is
+    resolved with its own response of the batch.
+
+    :param proxy: the proxy which sends the batches
+    :param window: the number of seconds calls are buffered
+    :param max_calls: the number of buffered calls which triggers sending
+    """
+    def __init__(self, proxy, window, max_calls):
+        self._proxy = proxy
+        self._window = window
+        self._max_calls = max_calls
+        self._lock = threading.Lock()
+        self._buffers = {}
+        self._timer = None
+
+    def add(self, server_id, request):
+        """Buffer the request to the given server.
+
+        :rtype: :class:`RpcFuture` of the call
+        """
+        future = self._proxy._make_future()
+        with self._lock:
+            calls = self._buffers.setdefault(server_id, [])
+            calls.append((request, future))
+            if len(calls) >= self._max_calls:
+                del self._buffers[server_id]
+            else:
+                calls = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self._window, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        if calls is not None:
+            self._send(server_id, calls)
+        return future
+
+    def flush(self):
+        """Send all the buffered calls."""
+        with self._lock:
+            buffers, self._buffers = self._buffers, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        for server_id, calls in buffers.items():
+            self._send(server_id, calls)
+
+    def _send(self, server_id, calls):
+        LOG.debug("Send {0} coalesced calls to server {1}.".format(
+            len(calls), server_id))
+        # the calls of a batch share the earliest deadline
+        deadlines = [future.deadline for _, future in calls
+                     if future.deadline is not None]
+        deadline = min(deadlines) if deadlines else None
+        timeout = (max(deadline - time.time(), 0.001)
+                   if deadline is not None else 0)
+        try:
+            batch = self._proxy._send(
+                pr.RpcBatchRequest([request for request, _ in calls]),
+                server_id, timeout=timeout)
+        except Exception as e:
+            LOG.exception("Failed to send coalesced calls.")
+            self._resolve(calls, error=e)
+            return
+
+        batch.deadline = deadline
+        for _, future in calls:
+            future.batch = batch
+        batch.add_done_callback(lambda f: self._resolve(calls, batch=f))
+
+    def _resolve(self, calls, batch=None, error=None):
+        """Resolve the futures of the calls with the responses of the batch
+        or with the error.
+        """
+        if batch is not None:
+            if batch.cancelled():
+                error = futures.CancelledError()
+            else:
+                error = batch.exception()
+        if error is not None:
+            responses = [pr.RpcResponse(error)] * len(calls)
+        else:
+            responses = batch.result()
+        call_info = batch.call_info if batch is not None else None
+        for (_, future), response in zip(calls, responses):
+            if self._proxy._discard(future):
+                future.set_response(response, call_info)
+
+# ===========================================================================
+
+
+class Batch(object):
+    """This class queues remote-method-calls locally and sends them to the
+    server in one message, like `xmlrpclib.MultiCall`. The server executes
+    the calls in order and returns all the results in one message.
+
+    Typical use:
+
+        >> batch = my_proxy.start_batch()
+        >> batch.add(1, 2)
+        >> batch.add(3, 4)
+        >> add_1_2, add_3_4 = batch()
+
+    :param proxy: the proxy which sends the batch
+    """
+    def __init__(self, proxy):
+        self._proxy = proxy
+        self._requests = []
+
+    def __queue(self, func_name, func_args, func_kwargs):
+        self._requests.append(pr.RpcRequest(func_name, func_args,
+                                            func_kwargs))
+
+    def __getattr__(self, name):
+        return _Method(self.__queue, name)
+
+    def __len__(self):
+        return len(self._requests)
+
+    def send(self):
+        """Send the queued calls without waiting for their results.
+
+        :rtype: :class:`RpcFuture` with the list of `RpcResponse` as result
+        """
+        return self._proxy._send(pr.RpcBatchRequest(self._requests))
+
+    def __call__(self):
+        """Send the queued calls and wait for their results.
+
+        :rtype: :class:`BatchResults`
+        """
+        return BatchResults(self.send().result())
+
+
+class BatchResults(object):
+    """This class holds the results of a batch. Accessing the result of a
+    call which raised an exception on the server raises that exception.
+
+    :param responses: list of `RpcResponse` in the order of the calls
+    """
+    def __init__(self, responses):
+        self._responses = responses
+
+    def __len__(self):
+        return len(self._responses)
+
+    def __getitem__(self, index):
+        response = self._responses[index]
+        if response.is_exception:
+            raise response.result
+        return response.result
+
+    def __iter__(self):
+        for index in range(len(self._responses)):
+            yield self[index]
+
+
+class BroadcastResults(BatchResults):
+    """This class holds the responses of a broadcast call in the order of
+    their arrival, one per server instance.
+
+    :param responses: list of `RpcResponse`
+    """
+    @property
+    def results(self):
+        """The results of the instances which succeeded."""
+        return [response.result for response in self._responses
+                if not response.is_exception]
+
+    @property
+    def errors(self):
+        """The exceptions of the instances which failed."""
+        return [response.result for response in self._responses
+                if response.is_exception]
+
+# ===========================================================================
+
+
+class ScatterResults(object):
+    """This class holds the results of a scatter-gather call per server id.
+    Accessing the result of a server which failed raises its exception,
+    `RpcTimeout` for a server which didn't respond in time.
+
+    :param results: dictionary of server id to the result
+    :param errors: dictionary of server id to the exception
+    """
+    def __init__(self, results, errors):
+        self.results = results
+        self.errors = errors
+
+    @property
+    def timeouts(self):
+        """The ids of the servers which didn't respond in time."""
+        return [server_id for server_id, error in self.errors.items()
+                if isinstance(error, exc.RpcTimeout)]
+
+    def __len__(self):
+        return len(self.results) + len(self.errors)
+
+    def __getitem__(self, server_id):
+        if server_id in self.errors:
+            raise self.errors[server_id]
+        return self.results[server_id]
+
+    def __iter__(self):
+        for server_id in self.results:
+            yield server_id
+        for server_id in self.errors:
+            yield server_id
+
+# ===========================================================================
+
+
+class _Dispatcher(object):
+    """This class is used to build remote-methods on top of a custom send
+    function of the Proxy.
+
+    :param send: the function that should be executed on Proxy
+    """
+    def __init__(self, send):
+        self._send = send
+
+    def __getattr__(self, name):
+        return _Method(self._send, name)
+
+# ===========================================================================
+
+
 class _Method(object):
     """This class is used to realize remote-method-calls.
 
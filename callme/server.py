@@ -29,18 +29,50 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import functools
+import inspect
 import logging
 import socket
+import tempfile
 import threading
+import time
+import uuid
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from concurrent import futures
 import kombu
+import kombu.exceptions
+import kombu.serialization
 
 from callme import base
+from callme import cache as cache_
+from callme import compression as cmp
 from callme import exceptions as exc
+from callme import metrics as metrics_
+from callme import profiling as profiling_
 from callme import protocol as pr
 
 LOG = logging.getLogger(__name__)
 
+MAX_WORKERS = 10
+MAX_BACKLOG = 100
+
+POLL_INTERVAL = 1
+ACK_POLL_INTERVAL = 0.01
+STREAM_CHUNK_SIZE = 100
+
+# uploads larger than this number of bytes are spooled to disk
+UPLOAD_SPOOL_SIZE = 1024 * 1024
+# uploads without a new chunk for this number of seconds are dropped
+UPLOAD_EXPIRY = 600
+
+BACKLOG_BLOCK = 'block'
+BACKLOG_REJECT = 'reject'
+
 
 class Server(base.Base):
     """This Server class is used to provide an RPC server.
@@ -53,10 +85,46 @@ class Server(base.Base):
     :keyword amqp_port: the port of the AMQP Broker
     :keyword ssl: use SSL connection for the AMQP Broker
     :keyword threaded: use of multithreading, if set to true RPC call-execution
-        will processed parallel (one thread per call) which dramatically
-        improves performance
+        will processed parallel (by a pool of worker threads) which
+        dramatically improves performance
     :keyword durable: make all exchanges and queues durable
     :keyword auto_delete: delete queues after all connections are closed
+    :keyword max_workers: number of worker threads in threaded mode
+    :keyword max_backlog: number of requests waiting for a free worker in
+        threaded mode
+    :keyword backlog_policy: what happens to a request when the backlog is
+        full, `block` the consumer until a worker is free or `reject` the
+        request with the `ServerBusy` exception
+    :keyword use_processes: execute the registered functions in a pool of
+        worker processes by default (see :func:`register_function`)
+    :keyword max_processes: number of worker processes, defaults to the number
+        of CPUs
+    :keyword prefetch_count: number of unacknowledged requests the broker
+        delivers to this server at once, unlimited by default
+    :keyword ack_late: acknowledge the requests after their response has been
+        published instead of on receipt, unacknowledged requests of a crashed
+        server are redelivered to the other servers
+    :keyword serializer: serializer of the responses if the serializer of the
+        request is unknown, otherwise the server responds with the serializer
+        of the request
+    :keyword compression: codec compressing large responses, e.g. `zlib` or
+        `lzma` (see :mod:`callme.compression`)
+    :keyword compression_threshold: responses smaller than this number of
+        bytes are not compressed
+    :keyword stream_chunk_size: number of items yielded by a generator
+        function which are published in one message
+    :keyword single_flight: identical requests arriving while the first one
+        is executed wait for its result instead of executing the function
+        again by default (see :func:`register_function`)
+    :keyword transport_options: options of the kombu transport, e.g. the
+        `polling_interval` of the in-memory transport, publisher confirms
+        (`confirm_publish`) are on by default with py-amqp
+    :keyword metrics: a :class:`callme.metrics.MetricsHook` recording the
+        call counts, latencies and the number of requests in progress, e.g.
+        :class:`callme.metrics.Metrics`
+    :keyword profiling: register the built-in `__callme_profile__` function
+        which profiles the requests of this server, needs a threaded server
+        (see :func:`profile_requests`)
     """
 
     def __init__(self,
@@ -69,21 +137,148 @@ class Server(base.Base):
                  ssl=False,
                  threaded=False,
                  durable=False,
-                 auto_delete=True):
+                 auto_delete=True,
+                 max_workers=MAX_WORKERS,
+                 max_backlog=MAX_BACKLOG,
+                 backlog_policy=BACKLOG_BLOCK,
+                 use_processes=False,
+                 max_processes=None,
+                 prefetch_count=None,
+                 ack_late=False,
+                 serializer=pr.PICKLE,
+                 compression=None,
+                 compression_threshold=cmp.THRESHOLD,
+                 stream_chunk_size=STREAM_CHUNK_SIZE,
+                 single_flight=False,
+                 transport_options=None,
+                 metrics=None,
+                 profiling=False):
         super(Server, self).__init__(amqp_host, amqp_user, amqp_password,
-                                     amqp_vhost, amqp_port, ssl)
+                                     amqp_vhost, amqp_port, ssl,
+                                     compression, compression_threshold,
+                                     transport_options)
+        if backlog_policy not in (BACKLOG_BLOCK, BACKLOG_REJECT):
+            raise ValueError("Unknown backlog policy '{0}'."
+                             .format(backlog_policy))
+        if profiling and not threaded:
+            raise ValueError("Profiling needs a threaded server.")
         self._server_id = server_id
         self._threaded = threaded
+        self._max_workers = max_workers
+        self._backlog_policy = backlog_policy
+        self._slots = threading.BoundedSemaphore(max_workers + max_backlog)
+        self._executor = None
+        self._use_processes = use_processes
+        self._max_processes = max_processes
+        self._process_executor = None
+        self._process_executor_lock = threading.Lock()
+        self._prefetch_count = prefetch_count
+        self._ack_late = ack_late
+        self._acks = queue.Queue()
+        self._unacked = 0
+        # responses of the worker processes, published by the consumer thread
+        self._responses = queue.Queue()
+        self._unpublished = 0
+        self._consuming = False
+        self._responses_lock = threading.Lock()
+        self._serializer = serializer
+        self._stream_chunk_size = stream_chunk_size
         self._running = threading.Event()
         self._durable = durable
         self._auto_delete = auto_delete
         self._func_dict = {}
+        self._process_funcs = set()
+        self._caches = {}
+        self._single_flight = single_flight
+        self._single_flight_funcs = set()
+        # executions of the single-flight functions in progress
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        # routing key of the queue of this server instance
+        self._instance_key = 'server_{0}_queue_{1}'.format(server_id,
+                                                           uuid.uuid4().hex)
+        self._uploads = {}
+        self._metrics = metrics
+        self._in_flight = 0
+        self._backlog = 0
+        self._gauges_lock = threading.Lock()
+        self._expired = 0
+        # the running profiling session
+        self._profile = None
+        self._profile_lock = threading.Lock()
+        if profiling:
+            self.register_function(self.profile_requests,
+                                   profiling_.FUNCTION, use_process=False,
+                                   single_flight=False)
 
     @property
     def is_running(self):
         """Return whether server is running."""
         return self._running.is_set()
 
+    @property
+    def metrics(self):
+        """Return the metrics hook of the server or None."""
+        return self._metrics
+
+    @property
+    def expired_requests(self):
+        """Return the number of requests dropped because the deadline of
+        their call had passed.
+        """
+        return self._expired
+
+    def _metric_name(self, request):
+        """Get the function name the metrics of the request are recorded
+        under.
+
+        :rtype: string or None if the request is not recorded, e.g. the
+            function is not registered
+        """
+        if isinstance(request, pr.RpcBatchRequest):
+            return metrics_.BATCH
+        if (isinstance(request, pr.RpcRequest) and
+                request.func_name in self._func_dict):
+            return request.func_name
+        return None
+
+    def _update_gauges(self, in_flight=0, backlog=0):
+        """Update the numbers of requests in progress and waiting for a
+        worker thread.
+        """
+        if self._metrics is None:
+            return
+        with self._gauges_lock:
+            self._in_flight += in_flight
+            self._backlog += backlog
+            if in_flight:
+                self._metrics.set_in_flight(self._in_flight)
+            if backlog:
+                self._metrics.set_backlog(self._backlog)
+
+    def _on_message(self, message):
+        """This method is automatically called when a message is incoming,
+        it deserializes the body and passes it to :meth:`_on_request`.
+        """
+        begin = time.time()
+        try:
+            request = message.decode()
+        except Exception:
+            LOG.exception("Failed to deserialize the message, it is "
+                          "dropped.")
+            try:
+                message.ack()
+            except Exception:
+                LOG.exception("Failed to acknowledge AMQP message.")
+            return
+        if (self._metrics is not None and
+                message.properties.get('type') != pr.UPLOAD_CHUNK):
+            request = pr.decode(request)
+            name = self._metric_name(request)
+            if name is not None:
+                self._metrics.observe_decode(name, time.time() - begin)
+        self._on_request(request, message)
+
     def _on_request(self, request, message):
         """This method is automatically called when a request is incoming.
 
@@ -92,39 +287,367 @@ class Server(base.Base):
         :param message: the plain amqp kombu.message with additional
             information
         """
+        received = time.time()
         LOG.debug("Got request: {0}".format(request))
+        if self._ack_late:
+            self._unacked += 1
+        else:
+            try:
+                message.ack()
+            except Exception:
+                LOG.exception("Failed to acknowledge AMQP message.")
+                return
+            else:
+                LOG.debug("AMQP message acknowledged.")
+
+        if message.properties.get('type') == pr.UPLOAD_CHUNK:
+            self._on_upload_chunk(request, message)
+            self._request_done(message)
+            return
+
+        # check request type
+        request = pr.decode(request)
+        if not isinstance(request, (pr.RpcRequest, pr.RpcBatchRequest)):
+            LOG.warning("Request is not a `RpcRequest` or `RpcBatchRequest` "
+                        "instance.")
+            # answer the callers instead of letting them time out
+            if ('correlation_id' in message.properties and
+                    'reply_to' in message.properties):
+                reply = self._get_reply_properties(message)
+                self._publish_response(
+                    pr.RpcResponse(ValueError("Malformed request.")), *reply)
+            self._request_done(message)
+            return
+
+        if self._drop_expired(request, message):
+            self._request_done(message)
+            return
+
+        if isinstance(request, pr.RpcRequest):
+            try:
+                request = self._resolve_uploads(request)
+            except KeyError as e:
+                LOG.error("Upload {0} is missing.".format(e))
+                reply = self._get_reply_properties(message)
+                if reply is not None:
+                    self._publish_response(pr.RpcResponse(ValueError(
+                        "Upload {0} is missing.".format(e))), *reply)
+                self._request_done(message)
+                return
+
+        # process request
+        if self._threaded or self._in_process(request):
+            self._submit_request(request, message, received)
+        else:
+            self._update_gauges(in_flight=1)
+            try:
+                self._process_request(request, message, received)
+            finally:
+                self._update_gauges(in_flight=-1)
+            self._request_done(message)
+
+    def _drop_expired(self, request, message):
+        """Drop the request if the deadline of its call has passed, the
+        proxy has given up waiting for the response then.
+
+        :rtype: True if the request is dropped
+        """
+        try:
+            deadline = float(message.headers[pr.DEADLINE])
+        except (KeyError, TypeError, ValueError):
+            return False
+        if time.time() < deadline:
+            return False
+        LOG.warning("The {0} request expired, it is dropped."
+                    .format(request))
+        with self._gauges_lock:
+            self._expired += 1
+        if self._metrics is not None:
+            name = self._metric_name(request)
+            if name is not None:
+                self._metrics.observe_expired(name)
+        return True
+
+    def _on_upload_chunk(self, data, message):
+        """Append the chunk to its upload. The server instance receiving the
+        first chunk of a call responds with the routing key of its own queue,
+        so the remaining chunks and the request follow to this instance.
+        """
+        upload_id = message.properties.get('message_id')
+        now = time.time()
+        if upload_id not in self._uploads:
+            self._drop_expired_uploads(now)
+            self._uploads[upload_id] = [tempfile.SpooledTemporaryFile(
+                UPLOAD_SPOOL_SIZE), now]
+        upload = self._uploads[upload_id]
+        upload[0].write(data)
+        upload[1] = now
+
+        if message.properties.get('correlation_id'):
+            reply = self._get_reply_properties(message)
+            if reply is not None:
+                self._publish_response(pr.RpcResponse(self._instance_key),
+                                       *reply)
+
+    def _drop_expired_uploads(self, now):
+        """Drop the uploads whose request never arrived."""
+        for upload_id, (upload, last_chunk) in list(self._uploads.items()):
+            if now - last_chunk > UPLOAD_EXPIRY:
+                LOG.warning("Upload {0} expired.".format(upload_id))
+                upload.close()
+                del self._uploads[upload_id]
+
+    def _resolve_uploads(self, request):
+        """Replace the `RpcUpload` arguments of the request with the
+        uploaded data.
+
+        :raises: KeyError if an upload is missing
+        """
+        def resolve(arg):
+            if not isinstance(arg, pr.RpcUpload):
+                return arg
+            upload = self._uploads.pop(arg.upload_id)[0]
+            upload.seek(0)
+            if not arg.binary:
+                return upload
+            try:
+                return upload.read()
+            finally:
+                upload.close()
+
+        args = list(request.func_args) + list(request.func_kwargs.values())
+        if not any(isinstance(arg, pr.RpcUpload) for arg in args):
+            return request
+        return pr.RpcRequest(request.func_name,
+                             [resolve(arg) for arg in request.func_args],
+                             dict((key, resolve(arg)) for key, arg
+                                  in request.func_kwargs.items()))
+
+    def _request_done(self, message):
+        """Mark the request message as done, in the late acknowledgement
+        mode the message is acknowledged by the consumer thread.
+        """
+        if self._ack_late:
+            self._acks.put(message)
+
+    def _flush_acks(self):
+        """Acknowledge the messages of the done requests."""
+        while True:
+            try:
+                message = self._acks.get_nowait()
+            except queue.Empty:
+                return
+            self._unacked -= 1
+            try:
+                message.ack()
+            except Exception:
+                LOG.exception("Failed to acknowledge AMQP message.")
+            else:
+                LOG.debug("AMQP message acknowledged.")
+
+    def _publish_later(self, publish):
+        """Queue the publication of a response for the consumer thread, once
+        the consumer is gone the response is published right away.
+
+        :param publish: the callable publishing the response
+        """
+        with self._responses_lock:
+            if self._consuming:
+                self._responses.put(publish)
+                return
+        self._publish_now(publish)
+
+    def _publish_now(self, publish):
         try:
-            message.ack()
+            publish()
         except Exception:
-            LOG.exception("Failed to acknowledge AMQP message.")
-        else:
-            LOG.debug("AMQP message acknowledged.")
+            LOG.exception("Failed to publish the response.")
 
-            # check request type
-            if not isinstance(request, pr.RpcRequest):
-                LOG.warning("Request is not a `RpcRequest` instance.")
+    def _flush_responses(self):
+        """Publish the responses queued by the worker processes."""
+        while True:
+            try:
+                publish = self._responses.get_nowait()
+            except queue.Empty:
                 return
+            self._unpublished -= 1
+            self._publish_now(publish)
 
-            # process request
-            if self._threaded:
-                p = threading.Thread(target=self._process_request,
-                                     args=(request, message))
-                p.daemon = True
-                p.start()
-                LOG.debug("New thread spawned to process the {0} request."
-                          .format(request))
+    def _get_process_executor(self):
+        """Return the pool of worker processes, it is created on first
+        use so that functions registered after the start can use it too.
+        """
+        with self._process_executor_lock:
+            if self._process_executor is None:
+                self._process_executor = futures.ProcessPoolExecutor(
+                    self._max_processes)
+            return self._process_executor
+
+    def _submit_request(self, request, message, received=None):
+        """Hand the request over to the worker pool, as soon as the backlog
+        is full the backlog policy applies.
+
+        :param received: the time the request was received
+        """
+        block = self._backlog_policy == BACKLOG_BLOCK
+        if not self._slots.acquire(block):
+            LOG.warning("Backlog is full, the {0} request is rejected."
+                        .format(request))
+            self._reject_request(request, message)
+            self._request_done(message)
+            return
+
+        try:
+            if self._in_process(request):
+                future = self._submit_to_processes(request, message,
+                                                   received)
             else:
-                self._process_request(request, message)
+                self._update_gauges(backlog=1)
+                try:
+                    future = self._executor.submit(self._run_request,
+                                                   request, message, received)
+                except Exception:
+                    self._update_gauges(backlog=-1)
+                    raise
+        except Exception:
+            self._slots.release()
+            raise
+        if future is None:
+            self._slots.release()
+            self._request_done(message)
+            return
 
-    def _process_request(self, request, message):
-        """Process incoming request."""
-        LOG.debug("Start processing request {0}.".format(request))
+        def done(future):
+            self._slots.release()
+            self._request_done(message)
+
+        future.add_done_callback(done)
+        LOG.debug("The {0} request is submitted to the worker pool."
+                  .format(request))
+
+    def _run_request(self, request, message, received=None):
+        """Process the request in a worker thread."""
+        self._update_gauges(in_flight=1, backlog=-1)
+        try:
+            self._process_request(request, message, received)
+        finally:
+            self._update_gauges(in_flight=-1)
+
+    def _in_process(self, request):
+        """Return whether the request is executed in a worker process."""
+        return (isinstance(request, pr.RpcRequest) and
+                request.func_name in self._process_funcs)
+
+    def _submit_to_processes(self, request, message, received=None):
+        """Execute the request in the pool of worker processes, the response
+        is published by the consumer thread once the execution is done.
+
+        :param received: the time the request was received
+
+        :rtype: the future done once the response is published or None if
+            the request can't be answered
+        """
+        reply = self._get_reply_properties(message)
+        if reply is None:
+            return None
+
+        begin = time.time()
+        response = self._get_cached(request)
+        if response is not None:
+            self._publish_response(response, *reply, headers=self._timing(
+                message, received, begin, time.time()))
+            return None
+
+        self._update_gauges(in_flight=1)
+        published = futures.Future()
+
+        def publish(response, finished):
+            try:
+                self._respond(request, response, reply,
+                              self._timing(message, received, begin,
+                                           finished))
+            finally:
+                published.set_result(None)
+
+        def done(flight):
+            response = flight.result()
+            if response is None:
+                response = pr.RpcResponse(RuntimeError(
+                    "The identical request failed."))
+            self._update_gauges(in_flight=-1)
+            finished = time.time()
+            if self._metrics is not None:
+                self._metrics.observe_execution(request.func_name,
+                                                finished - begin,
+                                                response.is_exception)
+            # a slow publication must not hold up the pool's management
+            # thread, which collects the results of all the workers
+            self._publish_later(functools.partial(publish, response,
+                                                  finished))
+
+        # like in `_execute` identical requests share a future of the
+        # `RpcResponse`, whichever path executes the function
+        key = self._flight_key(request)
+        with self._flights_lock:
+            flight = self._flights.get(key) if key is not None else None
+            if flight is None:
+                LOG.debug("Call function in worker process with args {!r}, "
+                          "kwargs {!r}".format(request.func_args,
+                                               request.func_kwargs))
+                flight = futures.Future()
+                execution = self._get_process_executor().submit(
+                    self._func_dict[request.func_name],
+                    *request.func_args, **request.func_kwargs)
+                if key is not None:
+                    self._flights[key] = flight
+                execution.add_done_callback(functools.partial(
+                    self._end_execution, request, key, flight))
+            else:
+                LOG.debug("Join the execution of the identical {0} request."
+                          .format(request))
+        self._unpublished += 1
+        flight.add_done_callback(done)
+        return published
+
+    def _end_execution(self, request, key, flight, execution):
+        """Resolve the flight with the response of the execution in a worker
+        process.
+        """
+        error = execution.exception()
+        if error is not None:
+            LOG.error("Exception happened: {0}".format(error))
+            response = pr.RpcResponse(error)
+        else:
+            response = pr.RpcResponse(execution.result())
+            self._put_cached(request, response.result)
+        if key is not None:
+            self._end_flight(key, flight)
+        flight.set_result(response)
+
+    def _reject_request(self, request, message):
+        """Respond with the `ServerBusy` exception without executing the
+        request.
+        """
+        reply = self._get_reply_properties(message)
+        if reply is None:
+            return
+        response = pr.RpcResponse(exc.ServerBusy(
+            "Server '{0}' is busy".format(self._server_id)))
+        self._publish_response(response, *reply)
+
+    def _get_reply_properties(self, message):
+        """Get the `reply_to` and `correlation_id` message properties and
+        the serializer of the response.
+
+        :rtype: tuple of `reply_to`, `correlation_id` and serializer or None
+            if one of the properties is missing
+        """
         # get the correlation_id message property
         try:
             correlation_id = message.properties['correlation_id']
         except KeyError:
             LOG.error("The 'correlation_id' message property is missing.")
-            return
+            return None
         else:
             LOG.debug("Correlation id: {0}".format(correlation_id))
 
@@ -133,49 +656,367 @@ class Server(base.Base):
             reply_to = message.properties['reply_to']
         except KeyError:
             LOG.error("The 'reply_to' message property is missing.")
-            return
+            return None
         else:
             LOG.debug("Reply to: {0}".format(reply_to))
 
-        # execute function
+        # respond with the serializer of the request
+        serializer = kombu.serialization.registry.type_to_name.get(
+            message.content_type)
+        if serializer not in pr.SERIALIZERS:
+            serializer = self._serializer
+        return reply_to, correlation_id, serializer
+
+    def _process_request(self, request, message, received=None):
+        """Process incoming request, under the profiler while a profiling
+        session is running.
+
+        :param received: the time the request was received
+        """
+        # the request may have expired while waiting for a worker
+        if self._drop_expired(request, message):
+            return
+        session = self._profile
+        if session is not None and not (
+                isinstance(request, pr.RpcRequest) and
+                request.func_name == profiling_.FUNCTION):
+            session.run(self._handle_request, request, message, received)
+        else:
+            self._handle_request(request, message, received)
+
+    def _handle_request(self, request, message, received=None):
+        """Execute the request and publish its response."""
+        LOG.debug("Start processing request {0}.".format(request))
+        reply = self._get_reply_properties(message)
+        if reply is None:
+            return
+
+        started = time.time()
+        response = self._execute(request)
+        self._respond(request, response, reply,
+                      self._timing(message, received, started, time.time()))
+
+    @staticmethod
+    def _timing(message, received, started, finished):
+        """Get the headers of the response with the timestamps of the call,
+        the time the proxy sent the request is returned as well.
+
+        :rtype: dict or None if the receive time is unknown
+        """
+        if received is None:
+            return None
+        headers = {pr.RECEIVED: received,
+                   pr.STARTED: started,
+                   pr.FINISHED: finished}
+        sent = (message.headers or {}).get(pr.SENT)
+        if sent is not None:
+            headers[pr.SENT] = sent
+        return headers
+
+    def _respond(self, request, response, reply, headers=None):
+        """Publish the response, or stream the items if the function of
+        the request is a generator function.
+        """
+        begin = time.time()
+        if (isinstance(response, pr.RpcResponse) and
+                inspect.isgenerator(response.result)):
+            self._publish_stream(response.result, *reply, headers=headers)
+        else:
+            self._publish_response(response, *reply, headers=headers)
+        if self._metrics is not None:
+            name = self._metric_name(request)
+            if name is not None:
+                self._metrics.observe_publish(name, time.time() - begin)
+
+    def _execute(self, request):
+        """Execute the function of the request, or the functions of all the
+        requests of a batch request.
+
+        :rtype: `RpcResponse` with the result or the raised exception, or
+            `RpcBatchResponse` with a response per request of the batch
+        """
+        if isinstance(request, pr.RpcBatchRequest):
+            return pr.RpcBatchResponse([self._collect(self._execute(r))
+                                        for r in request.requests])
+
+        response = self._get_cached(request)
+        if response is not None:
+            return response
+
+        key = self._flight_key(request)
+        if key is None:
+            return self._call(request)
+
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = futures.Future()
+        if not leader:
+            LOG.debug("Join the execution of the identical {0} request."
+                      .format(request))
+            response = flight.result()
+            if response is None or inspect.isgenerator(response.result):
+                # a generator can't be shared, execute the request again
+                return self._call(request)
+            return response
+
+        response = None
+        try:
+            response = self._call(request)
+        finally:
+            self._end_flight(key, flight)
+            flight.set_result(response)
+        return response
+
+    def _flight_key(self, request):
+        """Get the key identical requests of a single-flight function share.
+
+        :rtype: the key or None if the request is executed on its own
+        """
+        if request.func_name not in self._single_flight_funcs:
+            return None
+        key = request.func_name, cache_.make_key(request.func_args,
+                                                 request.func_kwargs)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _end_flight(self, key, flight):
+        """Stop identical requests from joining the finished execution."""
+        with self._flights_lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def _call(self, request):
+        """Call the function of the request.
+
+        :rtype: `RpcResponse` with the result or the raised exception
+        """
+        begin = time.time()
+        response = self._invoke(request)
+        if self._metrics is not None:
+            name = self._metric_name(request)
+            if name is not None:
+                self._metrics.observe_execution(name, time.time() - begin,
+                                                response.is_exception)
+        return response
+
+    def _invoke(self, request):
+        """Invoke the function of the request in this process or in a
+        worker process.
+
+        :rtype: `RpcResponse` with the result or the raised exception
+        """
         try:
             LOG.debug("Call function with args {!r}, kwargs {!r}".format(
                 request.func_args, request.func_kwargs))
-            result = self._func_dict[request.func_name](*request.func_args,
-                                                        **request.func_kwargs)
+            if request.func_name in self._process_funcs:
+                result = self._get_process_executor().submit(
+                    self._func_dict[request.func_name],
+                    *request.func_args, **request.func_kwargs).result()
+            else:
+                result = self._func_dict[request.func_name](
+                    *request.func_args, **request.func_kwargs)
         except Exception as e:
             LOG.error("Exception happened: {0}".format(e))
-            response = pr.RpcResponse(e)
+            return pr.RpcResponse(e)
         else:
             LOG.debug("Result: {!r}".format(result))
-            response = pr.RpcResponse(result)
+            if not inspect.isgenerator(result):
+                self._put_cached(request, result)
+            return pr.RpcResponse(result)
+
+    def _get_cached(self, request):
+        """Get the cached response of the request.
+
+        :rtype: `RpcResponse` or None if the result is not cached
+        """
+        cache = self._caches.get(request.func_name)
+        if cache is None:
+            return None
+        result = cache.get(request.func_args, request.func_kwargs)
+        if result is cache_.MISS:
+            return None
+        LOG.debug("Cached result: {!r}".format(result))
+        return pr.RpcResponse(result)
 
+    def _put_cached(self, request, result):
+        """Cache the result of the request if its function is cached."""
+        cache = self._caches.get(request.func_name)
+        if cache is not None:
+            cache.put(request.func_args, request.func_kwargs, result)
+
+    @staticmethod
+    def _collect(response):
+        """Collect the items of a generator function into a list, streams
+        are not supported within batches.
+        """
+        if inspect.isgenerator(response.result):
+            try:
+                return pr.RpcResponse(list(response.result))
+            except Exception as e:
+                LOG.error("Exception happened: {0}".format(e))
+                return pr.RpcResponse(e)
+        return response
+
+    def _publish_stream(self, items, reply_to, correlation_id,
+                        serializer=pr.PICKLE, headers=None):
+        """Publish the items yielded by a generator function in chunks of
+        `stream_chunk_size` items, the last chunk ends the stream. If the
+        generator raises an exception, the stream ends with the exception.
+        The headers are sent with the last message, the execution finishes
+        with the generator.
+        """
+        chunk = []
+        try:
+            for item in items:
+                chunk.append(item)
+                if len(chunk) >= self._stream_chunk_size:
+                    self._publish_response(pr.RpcStreamChunk(chunk),
+                                           reply_to, correlation_id,
+                                           serializer)
+                    chunk = []
+        except Exception as e:
+            LOG.error("Exception happened: {0}".format(e))
+            if chunk:
+                self._publish_response(pr.RpcStreamChunk(chunk),
+                                       reply_to, correlation_id, serializer)
+            last = pr.RpcResponse(e)
+        else:
+            last = pr.RpcStreamChunk(chunk, end=True)
+        if headers is not None:
+            headers = dict(headers)
+            headers[pr.FINISHED] = time.time()
+        self._publish_response(last, reply_to, correlation_id, serializer,
+                               headers=headers)
+
+    def _publish_response(self, response, reply_to, correlation_id,
+                          serializer=pr.PICKLE, headers=None):
+        """Publish the response to the exchange of the client, or through the
+        default exchange if the client uses direct reply-to.
+
+        :param headers: the message headers, e.g. the timestamps of the call
+        """
         LOG.debug("Publish response: {0}".format(response))
-        with kombu.producers[self._conn].acquire(block=True) as producer:
+        if reply_to.startswith(base.DIRECT_REPLY_TO):
+            exchange = ''
+            declare = []
+        else:
             exchange = self._make_exchange(reply_to,
                                            durable=self._durable,
                                            auto_delete=True)
-            producer.publish(body=response,
-                             serializer='pickle',
-                             exchange=exchange,
-                             correlation_id=correlation_id,
-                             declare=[exchange])
+            declare = [exchange]
+        try:
+            body = self._encode_body(pr.encode(response, serializer),
+                                     serializer)
+        except kombu.exceptions.EncodeError as e:
+            LOG.error("Failed to serialize the response: {0}".format(e))
+            body = self._encode_body(pr.encode(pr.RpcResponse(
+                kombu.exceptions.EncodeError(str(e))), serializer),
+                serializer)
+        with kombu.producers[self._conn].acquire(block=True) as producer:
+            self._publish(producer,
+                          declare=declare,
+                          exchange=exchange,
+                          routing_key=reply_to if not declare else None,
+                          correlation_id=correlation_id,
+                          headers=headers,
+                          **body)
 
-    def register_function(self, func, name=None):
+    def register_function(self, func, name=None, use_process=None,
+                          cache=None, single_flight=None):
         """Registers a function as rpc function so that is accessible from the
         proxy.
 
+        Functions executed in worker processes must be picklable (e.g.
+        defined at module level), as well as their arguments and results.
+
+        The items of a generator function are streamed to the proxy while
+        they are yielded, generator functions can't be executed in worker
+        processes.
+
         :param func: the function we want to provide as rpc method
         :param name: the name with which the function is visible to the clients
+        :param use_process: execute the function in the pool of worker
+            processes, defaults to the `use_processes` setting of the server
+        :param cache: a :class:`callme.cache.ResultCache` answering repeated
+            calls with equal arguments, only for functions without side
+            effects
+        :param single_flight: identical requests arriving while the first one
+            is executed wait for its result and are answered with it, only
+            for functions without side effects, defaults to the
+            `single_flight` setting of the server
         """
         if not callable(func):
             raise ValueError("The '{0}' is not callable.".format(func))
 
-        self._func_dict[name if name is not None else func.__name__] = func
+        name = name if name is not None else func.__name__
+        self._func_dict[name] = func
+        if use_process is None:
+            use_process = self._use_processes
+        if use_process:
+            self._process_funcs.add(name)
+        else:
+            self._process_funcs.discard(name)
+        if single_flight is None:
+            single_flight = self._single_flight
+        if single_flight:
+            self._single_flight_funcs.add(name)
+        else:
+            self._single_flight_funcs.discard(name)
+        if cache is not None:
+            self._caches[name] = cache
+        else:
+            self._caches.pop(name, None)
+
+    def profile_requests(self, seconds=profiling_.SECONDS, calls=None,
+                         sort='cumulative', limit=profiling_.LIMIT):
+        """Profile the requests processed by this server with `cProfile`
+        for the given number of seconds or calls and return the aggregated
+        stats. With `profiling` enabled the proxies call it as the
+        `__callme_profile__` function, the call must not time out before.
+
+        Functions executed in worker processes are not profiled, only the
+        processing of their requests by this process.
+
+        :param seconds: the maximum number of seconds to profile
+        :param calls: stop profiling after this number of requests
+        :param sort: the key the functions are sorted by, see
+            :meth:`pstats.Stats.sort_stats`
+        :param limit: the number of functions reported
+        :rtype: dict with the number of profiled `calls`, the `seconds` the
+            session lasted and the `report` of the stats as text
+        """
+        session = profiling_.Session(calls)
+        with self._profile_lock:
+            if self._profile is not None:
+                raise RuntimeError("A profiling session is already running.")
+            self._profile = session
+        LOG.info("Profiling the requests for {0} seconds.".format(seconds))
+        try:
+            session.wait(seconds)
+        finally:
+            with self._profile_lock:
+                self._profile = None
+        return session.report(sort, limit)
+
+    def get_cache(self, name):
+        """Return the result cache of the registered function, e.g. to
+        invalidate results or read its counters.
+
+        :param name: the name of the registered function
+        :rtype: :class:`callme.cache.ResultCache` or None
+        """
+        return self._caches.get(name)
 
     def start(self):
         """Start the server."""
         LOG.info("Server with id='{0}' started.".format(self._server_id))
+        if self._threaded:
+            self._executor = futures.ThreadPoolExecutor(self._max_workers)
         try:
             with kombu.connections[self._conn].acquire(block=True) as conn:
                 exchange = self._make_exchange(
@@ -186,24 +1027,84 @@ class Server(base.Base):
                     'server_{0}_queue'.format(self._server_id), exchange,
                     durable=self._durable,
                     auto_delete=self._auto_delete)
-                with conn.Consumer(queues=queue,
-                                   callbacks=[self._on_request],
-                                   accept=['pickle']):
+                broadcast_exchange = self._make_exchange(
+                    'server_{0}_broadcast_ex'.format(self._server_id),
+                    durable=self._durable,
+                    auto_delete=self._auto_delete,
+                    type='fanout')
+                # the chunks of an upload are routed to this instance only,
+                # broadcast requests to every instance
+                instance_queue = kombu.Queue(
+                    name=self._instance_key,
+                    bindings=[kombu.binding(exchange,
+                                            routing_key=self._instance_key),
+                              kombu.binding(broadcast_exchange)],
+                    auto_delete=True)
+                with conn.Consumer(queues=[queue, instance_queue],
+                                   on_message=self._on_message,
+                                   accept=list(pr.SERIALIZERS),
+                                   prefetch_count=self._prefetch_count):
                     self._running.set()
-                    while self.is_running:
-                        try:
-                            conn.drain_events(timeout=1)
-                        except socket.timeout:
-                            pass
-                        except Exception:
-                            LOG.exception("Draining events failed.")
-                            return
-                        except KeyboardInterrupt:
-                            LOG.info("Server with id='{0}' stopped.".format(
-                                self._server_id))
-                            return
+                    self._unpublished = 0
+                    with self._responses_lock:
+                        self._consuming = True
+                    try:
+                        self._consume(conn)
+                    finally:
+                        if self._ack_late:
+                            # answer and acknowledge the requests still in
+                            # progress
+                            self._shutdown_executors(wait=True)
+                        self._stop_consuming()
+                        self._flush_acks()
         except socket.error:
             raise exc.ConnectionError("Broker connection failed")
+        finally:
+            self._shutdown_executors(wait=False)
+
+    def _consume(self, conn):
+        """Consume the requests until the server is stopped."""
+        while self.is_running:
+            # acknowledgements of the requests in progress and responses of
+            # the worker processes are only sent between draining, so drain
+            # in short intervals meanwhile
+            interval = (ACK_POLL_INTERVAL
+                        if self._unacked or self._unpublished
+                        else POLL_INTERVAL)
+            try:
+                conn.drain_events(timeout=interval)
+            except socket.timeout:
+                pass
+            except conn.connection_errors + conn.channel_errors:
+                LOG.exception("Draining events failed.")
+                return
+            except Exception:
+                # a request failed, keep serving the others
+                LOG.exception("Processing a request failed.")
+            except KeyboardInterrupt:
+                LOG.info("Server with id='{0}' stopped.".format(
+                    self._server_id))
+                return
+            self._flush_responses()
+            self._flush_acks()
+
+    def _stop_consuming(self):
+        """Publish the queued responses, the responses of the executions
+        still in progress are published by the worker pool from now on.
+        """
+        with self._responses_lock:
+            self._consuming = False
+        self._flush_responses()
+
+    def _shutdown_executors(self, wait):
+        """Shutdown the pools of worker threads and processes."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+        with self._process_executor_lock:
+            executor, self._process_executor = self._process_executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
 
     def wait(self):
         """Wait until server is started."""
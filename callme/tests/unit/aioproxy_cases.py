@@ -0,0 +1,194 @@
+# Copyright (c) 2009-2014, Christian Haintz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+#     * Neither the name of callme nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# pylint: disable=W0212
+
+# The test cases of the asyncio proxy are collected by `test_aioproxy` on
+# Python 3.5+ only, older interpreters can't compile coroutines.
+
+import asyncio
+import threading
+import time
+
+import mock
+
+from callme import aioproxy
+from callme import exceptions as exc
+from callme import protocol as pr
+from callme import proxy
+from callme import test
+
+
+def _run(coro):
+    """Run the coroutine in a new event loop."""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+class TestAsyncProxy(test.MockTestCase):
+
+    def setUp(self):
+        super(TestAsyncProxy, self).setUp()
+
+        # mock kombu Connection
+        self.conn_mock, self.conn_inst_mock = self._mock_class(
+            proxy.kombu, 'BrokerConnection')
+        self.conn_inst_mock.drain_events.side_effect = (
+            lambda timeout: time.sleep(timeout))
+
+        # mock kombu Consumer
+        self.consumer_mock, self.consumer_inst_mock = self._mock_class(
+            proxy.kombu, 'Consumer')
+
+        # mock kombu producers
+        patcher = mock.patch.object(proxy.kombu, 'producers')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _make_proxy(self, **kwargs):
+        p = aioproxy.AsyncProxy('fooserver', **kwargs)
+        self.addCleanup(p.close)
+        return p
+
+    @staticmethod
+    def _respond(p, response):
+        corr_id, future = list(p._pending.items())[0]
+        message = mock.Mock(properties={'correlation_id': corr_id})
+        p._on_response(response, message)
+
+    def test_call_is_coroutine(self):
+        p = self._make_proxy()
+
+        async def call():
+            task = asyncio.ensure_future(p.foo.bar(1, b=2))
+            await asyncio.sleep(0.01)
+            self._respond(p, pr.RpcResponse('result'))
+            return await task
+
+        self.assertEqual(_run(call()), 'result')
+        self.assertEqual(p._pending, {})
+
+    def test_call_remote_exception(self):
+        p = self._make_proxy()
+
+        async def call():
+            task = asyncio.ensure_future(p.foo())
+            await asyncio.sleep(0.01)
+            self._respond(p, pr.RpcResponse(ValueError('test')))
+            return await task
+
+        self.assertRaises(ValueError, _run, call())
+
+    def test_call_timeout(self):
+        p = self._make_proxy(timeout=0.05)
+        self.assertRaises(exc.RpcTimeout, _run, p.foo())
+        self.assertEqual(p._pending, {})
+
+    def test_stream_async_iteration(self):
+        p = self._make_proxy(timeout=5)
+        ticks = []
+
+        async def tick():
+            while True:
+                ticks.append(None)
+                await asyncio.sleep(0.01)
+
+        async def call():
+            ticker = asyncio.ensure_future(tick())
+            task = asyncio.ensure_future(p.gen())
+            await asyncio.sleep(0.01)
+            self._respond(p, pr.RpcStreamChunk([0, 1]))
+            stream = await task
+            self.assertIsInstance(stream, aioproxy.AsyncResultStream)
+            threading.Timer(0.1, self._respond, [
+                p, pr.RpcStreamChunk([2], end=True)]).start()
+            items = [item async for item in stream]
+            ticker.cancel()
+            return items
+
+        self.assertEqual(_run(call()), [0, 1, 2])
+        # the event loop kept running while waiting for the last chunk
+        self.assertTrue(len(ticks) > 5)
+        self.assertEqual(p._pending, {})
+
+    def test_stream_async_timeout(self):
+        p = self._make_proxy(timeout=0.05)
+
+        async def call():
+            task = asyncio.ensure_future(p.gen())
+            await asyncio.sleep(0.01)
+            self._respond(p, pr.RpcStreamChunk([0]))
+            stream = await task
+            self.assertEqual(await stream.__anext__(), 0)
+            await stream.__anext__()
+
+        self.assertRaises(exc.RpcTimeout, _run, call())
+        self.assertEqual(p._pending, {})
+
+    def test_upload_does_not_block_loop(self):
+        p = self._make_proxy(timeout=5, upload_chunk_size=4)
+        published = []
+        ticks = []
+
+        def publish(**kwargs):
+            published.append(kwargs)
+            if 'correlation_id' not in kwargs:
+                return
+            future = p._pending[kwargs['correlation_id']]
+            result = ('instance_key' if kwargs.get('type') == pr.UPLOAD_CHUNK
+                      else 'result')
+            threading.Timer(0.1, future.set_response,
+                            [pr.RpcResponse(result)]).start()
+
+        async def tick():
+            while True:
+                ticks.append(None)
+                await asyncio.sleep(0.01)
+
+        async def call():
+            ticker = asyncio.ensure_future(tick())
+            result = await p.up(b'0123456789')
+            ticker.cancel()
+            return result
+
+        with mock.patch.object(p, '_publish_request', side_effect=publish):
+            self.assertEqual(_run(call()), 'result')
+
+        self.assertEqual([c.get('routing_key') for c in published],
+                         [None, 'instance_key', 'instance_key',
+                          'instance_key'])
+        # the event loop kept running while waiting for the first chunk
+        self.assertTrue(len(ticks) > 5)
@@ -0,0 +1,163 @@
+# Copyright (c) 2009-2014, Christian Haintz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+#     * Neither the name of callme nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# pylint: disable=W0212
+
+import mock
+
+from callme import base
+from callme import compression
+from callme import test
+
+
+class NotFound(Exception):
+    code = 404
+
+
+class TestBase(test.MockTestCase):
+
+    def setUp(self):
+        super(TestBase, self).setUp()
+
+        # mock kombu Connection
+        self.conn_mock, self.conn_inst_mock = self._mock_class(
+            base.kombu, 'BrokerConnection')
+
+        self.base = base.Base('localhost', 'guest', 'guest', '/', 5672, False)
+        self.channel = mock.Mock()
+        self.channel.connection.client.declared_entities = set()
+        self.entity = mock.MagicMock()
+        self.entity.__hash__.return_value = 42
+        self.entity.auto_delete = False
+
+    def test_declare_once(self):
+        self.base._declare(self.channel, [self.entity])
+        self.base._declare(self.channel, [self.entity])
+        self.entity.assert_called_once_with(self.channel)
+        self.entity.return_value.declare.assert_called_once_with()
+
+    def test_declare_auto_deleted_once_with_confirms(self):
+        self.base._confirm_publish = True
+        self.entity.auto_delete = True
+        self.base._declare(self.channel, [self.entity])
+        self.base._declare(self.channel, [self.entity])
+        self.entity.return_value.declare.assert_called_once_with()
+
+    def test_declare_auto_deleted_every_time_without_confirms(self):
+        self.base._confirm_publish = False
+        self.entity.auto_delete = True
+        self.base._declare(self.channel, [self.entity])
+        self.base._declare(self.channel, [self.entity])
+        self.assertEqual(self.entity.return_value.declare.call_count, 2)
+
+    def test_confirm_publish_default(self):
+        self.conn_inst_mock.transport.driver_name = 'py-amqp'
+        self.conn_inst_mock.transport_options = {}
+        b = base.Base('localhost', 'guest', 'guest', '/', 5672, False)
+        self.assertTrue(b._confirm_publish)
+        self.assertEqual(self.conn_inst_mock.transport_options,
+                         {'confirm_publish': True})
+
+        self.conn_inst_mock.transport_options = {'confirm_publish': False}
+        b = base.Base('localhost', 'guest', 'guest', '/', 5672, False)
+        self.assertFalse(b._confirm_publish)
+
+        self.conn_inst_mock.transport.driver_name = 'memory'
+        self.conn_inst_mock.transport_options = {}
+        b = base.Base('localhost', 'guest', 'guest', '/', 5672, False)
+        self.assertFalse(b._confirm_publish)
+
+    def test_declare_after_reconnect(self):
+        self.base._declare(self.channel, [self.entity])
+        self.channel.connection.client.declared_entities.clear()
+        self.base._declare(self.channel, [self.entity])
+        self.assertEqual(self.entity.return_value.declare.call_count, 2)
+
+    def test_declare_after_forget(self):
+        self.base._declare(self.channel, [self.entity])
+        self.base._forget_declarations()
+        self.base._declare(self.channel, [self.entity])
+        self.assertEqual(self.entity.return_value.declare.call_count, 2)
+
+    def test_forget_declarations_keeps_no_stale_entries(self):
+        declared = self.channel.connection.client.declared_entities
+        for _ in range(3):
+            self.base._declare(self.channel, [self.entity])
+            self.base._forget_declarations()
+        self.assertEqual(declared, set())
+        self.assertEqual(self.entity.return_value.declare.call_count, 3)
+
+    def test_publish_not_found(self):
+        producer = mock.Mock(channel=self.channel)
+        producer.connection.channel_errors = (NotFound,)
+        producer.publish.side_effect = [NotFound(), None]
+
+        self.base._publish(producer, declare=[self.entity], body='body')
+
+        self.assertEqual(producer.publish.call_count, 2)
+        producer.publish.assert_called_with(body='body')
+        producer.revive.assert_called_once_with(
+            producer.connection.channel.return_value)
+        self.assertEqual(self.entity.return_value.declare.call_count, 2)
+
+    def test_publish_other_channel_error(self):
+        producer = mock.Mock(channel=self.channel)
+        producer.connection.channel_errors = (NotFound,)
+        producer.publish.side_effect = NotFound()
+        producer.publish.side_effect.code = 403
+
+        self.assertRaises(NotFound, self.base._publish, producer,
+                          declare=[self.entity], body='body')
+        self.assertEqual(producer.publish.call_count, 1)
+
+    def test_unknown_compression(self):
+        self.assertRaises(ValueError, base.Base, 'localhost', 'guest',
+                          'guest', '/', 5672, False, compression='foo')
+
+    def test_encode_body_uncompressed(self):
+        b = base.Base('localhost', 'guest', 'guest', '/', 5672, False)
+        kwargs = b._encode_body({'a': 'x' * 5000}, 'json')
+        self.assertEqual(kwargs['content_type'], 'application/json')
+        self.assertNotIn('compression', kwargs)
+
+    def test_encode_body_threshold(self):
+        b = base.Base('localhost', 'guest', 'guest', '/', 5672, False,
+                      compression='zlib', compression_threshold=100)
+        self.assertNotIn('compression', b._encode_body('x' * 10, 'json'))
+        kwargs = b._encode_body('x' * 100, 'json')
+        self.assertEqual(kwargs['compression'], 'zlib')
+
+    def test_register_compression(self):
+        self.assertFalse(compression.is_registered('test-codec'))
+        compression.register('test-codec', lambda b: b, lambda b: b)
+        self.assertTrue(compression.is_registered('test-codec'))
+        base.Base('localhost', 'guest', 'guest', '/', 5672, False,
+                  compression='test-codec')
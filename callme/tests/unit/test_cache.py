@@ -0,0 +1,83 @@
+# Copyright (c) 2009-2014, Christian Haintz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+#     * Neither the name of callme nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import mock
+
+from callme import cache
+from callme import test
+
+
+class TestResultCache(test.MockTestCase):
+
+    def test_hit_and_miss(self):
+        c = cache.ResultCache()
+        self.assertIs(c.get([1], {'a': 2}), cache.MISS)
+        c.put([1], {'a': 2}, 'result')
+        self.assertEqual(c.get((1,), {'a': 2}), 'result')
+        self.assertEqual(c.stats(), {'hits': 1, 'misses': 1,
+                                     'evictions': 0, 'size': 1})
+
+    def test_lru_eviction(self):
+        c = cache.ResultCache(maxsize=2)
+        c.put([1], {}, 1)
+        c.put([2], {}, 2)
+        c.get([1], {})
+        c.put([3], {}, 3)
+        self.assertIs(c.get([2], {}), cache.MISS)
+        self.assertEqual(c.get([1], {}), 1)
+        self.assertEqual(c.evictions, 1)
+        self.assertEqual(len(c), 2)
+
+    def test_ttl(self):
+        c = cache.ResultCache(ttl=10)
+        with mock.patch.object(cache.time, 'time', return_value=100):
+            c.put([], {}, 'result')
+        with mock.patch.object(cache.time, 'time', return_value=109):
+            self.assertEqual(c.get([], {}), 'result')
+        with mock.patch.object(cache.time, 'time', return_value=110):
+            self.assertIs(c.get([], {}), cache.MISS)
+        self.assertEqual(len(c), 0)
+
+    def test_invalidate(self):
+        c = cache.ResultCache()
+        c.put([1], {}, 1)
+        c.put([2], {}, 2)
+        c.invalidate(1)
+        self.assertIs(c.get([1], {}), cache.MISS)
+        self.assertEqual(c.get([2], {}), 2)
+        c.clear()
+        self.assertEqual(len(c), 0)
+
+    def test_unhashable_arguments(self):
+        c = cache.ResultCache()
+        c.put([bytearray(b'a')], {}, 1)
+        self.assertIs(c.get([bytearray(b'a')], {}), cache.MISS)
+        self.assertEqual(len(c), 0)
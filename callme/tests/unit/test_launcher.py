@@ -0,0 +1,86 @@
+# Copyright (c) 2009-2014, Christian Haintz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+#     * Neither the name of callme nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# pylint: disable=W0212
+
+import os.path
+
+import mock
+
+from callme import launcher
+from callme import test
+
+
+class TestLauncher(test.MockTestCase):
+
+    def test_load_function(self):
+        self.assertEqual(launcher.load_function('os.path:join'),
+                         ('join', os.path.join))
+        self.assertEqual(launcher.load_function('os:path.join'),
+                         ('path.join', os.path.join))
+
+    def test_load_function_invalid(self):
+        self.assertRaises(ValueError, launcher.load_function, 'os.path')
+        self.assertRaises(ValueError, launcher.load_function, 'os:sep')
+        self.assertRaises(AttributeError, launcher.load_function, 'os:foo')
+
+    def test_parse_args(self):
+        server_kwargs, args = launcher.parse_args(
+            ['--server-id', 'fooserver', '--workers', '3', '--threads', '5',
+             'os.path:join'])
+        self.assertEqual(server_kwargs['server_id'], 'fooserver')
+        self.assertTrue(server_kwargs['threaded'])
+        self.assertEqual(server_kwargs['max_workers'], 5)
+        self.assertEqual(args.workers, 3)
+        self.assertEqual(args.functions, ['os.path:join'])
+
+    def test_supervise_restarts_exited_worker(self):
+        process_mock, _ = self._mock_class(launcher.multiprocessing,
+                                           'Process')
+        launch = launcher.Launcher({}, [], 2)
+        launch._supervise()
+        self.assertEqual(process_mock.call_count, 2)
+
+        alive, dead = mock.Mock(), mock.Mock()
+        alive.is_alive.return_value = True
+        dead.is_alive.return_value = False
+        launch._workers = [alive, dead]
+        launch._started = [0.0, 0.0]
+        launch._supervise()
+        self.assertEqual(process_mock.call_count, 3)
+        self.assertIs(launch._workers[0], alive)
+        self.assertIsNot(launch._workers[1], dead)
+
+    def test_watch_memory(self):
+        server = mock.Mock(is_running=True)
+        with mock.patch.object(launcher, 'max_rss', return_value=2048):
+            launcher._watch_memory(server, 1024)
+        server.stop.assert_called_once_with()
@@ -0,0 +1,85 @@
+# Copyright (c) 2009-2014, Christian Haintz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+#     * Neither the name of callme nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from callme import metrics
+from callme import test
+
+
+class TestMetrics(test.MockTestCase):
+
+    def test_histogram(self):
+        h = metrics.Histogram(buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3):
+            h.observe(value)
+        self.assertEqual(h.cumulative(), [(0.1, 2), (1.0, 3),
+                                          (float('inf'), 4)])
+        self.assertEqual(h.count, 4)
+        self.assertAlmostEqual(h.sum, 3.65)
+
+    def test_observe_execution(self):
+        m = metrics.Metrics()
+        m.observe_execution('add', 0.01, False)
+        m.observe_execution('add', 0.02, True)
+        self.assertEqual(m.calls['add'], 2)
+        self.assertEqual(m.errors['add'], 1)
+        self.assertEqual(m.execution['add'].count, 2)
+
+    def test_dump(self):
+        m = metrics.Metrics(buckets=(0.1,))
+        m.observe_execution('add', 0.05, True)
+        m.observe_decode('add', 0.2)
+        m.observe_publish(metrics.BATCH, 0.01)
+        m.observe_expired('add')
+        m.set_in_flight(3)
+        m.set_backlog(2)
+        lines = m.dump().splitlines()
+        self.assertIn('# TYPE callme_calls_total counter', lines)
+        self.assertIn('callme_calls_total{function="add"} 1', lines)
+        self.assertIn('callme_errors_total{function="add"} 1', lines)
+        self.assertIn('callme_expired_total{function="add"} 1', lines)
+        self.assertIn('# TYPE callme_execution_seconds histogram', lines)
+        self.assertIn('callme_execution_seconds_bucket'
+                      '{function="add",le="0.1"} 1', lines)
+        self.assertIn('callme_decode_seconds_bucket'
+                      '{function="add",le="0.1"} 0', lines)
+        self.assertIn('callme_decode_seconds_bucket'
+                      '{function="add",le="+Inf"} 1', lines)
+        self.assertIn('callme_decode_seconds_count{function="add"} 1', lines)
+        self.assertIn('callme_publish_seconds_count'
+                      '{function="<batch>"} 1', lines)
+        self.assertIn('callme_in_flight 3', lines)
+        self.assertIn('callme_backlog 2', lines)
+
+    def test_dump_escapes_labels(self):
+        m = metrics.Metrics(prefix='rpc')
+        m.observe_execution('a"b\\c', 0.01, False)
+        self.assertIn('rpc_calls_total{function="a\\"b\\\\c"} 1',
+                      m.dump().splitlines())
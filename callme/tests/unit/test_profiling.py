@@ -0,0 +1,63 @@
+# Copyright (c) 2009-2014, Christian Haintz
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#
+#     * Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+#     * Neither the name of callme nor the names of its contributors
+#       may be used to endorse or promote products derived from this
+#       software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from callme import profiling
+from callme import test
+
+
+def _work(n):
+    return sum(range(n))
+
+
+class TestSession(test.MockTestCase):
+
+    def test_report(self):
+        session = profiling.Session()
+        self.assertEqual(session.run(_work, 10), 45)
+        self.assertEqual(session.run(_work, n=5), 10)
+        session.wait(0)
+        report = session.report(limit=5)
+        self.assertEqual(report['calls'], 2)
+        self.assertIn('_work', report['report'])
+        self.assertGreaterEqual(report['seconds'], 0)
+
+    def test_calls_limit(self):
+        session = profiling.Session(calls=1)
+        session.run(_work, 10)
+        session.wait(5)
+        self.assertEqual(session.run(_work, 10), 45)
+        self.assertEqual(session.report()['calls'], 1)
+
+    def test_no_calls(self):
+        session = profiling.Session()
+        session.wait(0)
+        self.assertEqual(session.report()['calls'], 0)
+        self.assertEqual(session.report()['report'], '')
@@ -29,6 +29,7 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+from callme import exceptions
 from callme import protocol
 from callme import test
 
@@ -55,3 +56,104 @@ class TestRpcResponse(test.TestCase):
         response = protocol.RpcResponse(Exception('test'))
         self.assertIsInstance(response.result, Exception)
         self.assertTrue(response.is_exception)
+
+
+class TestEncoding(test.TestCase):
+
+    def test_pickle_keeps_instances(self):
+        request = protocol.RpcRequest('func', [1], {'a': 2})
+        self.assertIs(protocol.encode(request, 'pickle'), request)
+        self.assertIs(protocol.decode(request), request)
+
+    def test_request_dict(self):
+        request = protocol.RpcRequest('func', (1, 2), {'a': 3})
+        body = protocol.encode(request, 'json')
+        self.assertEqual(body, {'type': 'request', 'func_name': 'func',
+                                'func_args': [1, 2], 'func_kwargs': {'a': 3}})
+        decoded = protocol.decode(body)
+        self.assertIsInstance(decoded, protocol.RpcRequest)
+        self.assertEqual(decoded.func_name, 'func')
+        self.assertEqual(decoded.func_args, [1, 2])
+        self.assertEqual(decoded.func_kwargs, {'a': 3})
+
+    def test_response_dict(self):
+        body = protocol.encode(protocol.RpcResponse([1, 2]), 'msgpack')
+        self.assertEqual(body, {'type': 'response', 'result': [1, 2]})
+        decoded = protocol.decode(body)
+        self.assertIsInstance(decoded, protocol.RpcResponse)
+        self.assertEqual(decoded.result, [1, 2])
+
+    def test_builtin_exception_dict(self):
+        body = protocol.encode(protocol.RpcResponse(KeyError('key')), 'json')
+        decoded = protocol.decode(body)
+        self.assertTrue(decoded.is_exception)
+        self.assertIsInstance(decoded.result, KeyError)
+        self.assertEqual(decoded.result.args, ('key',))
+
+    def test_callme_exception_dict(self):
+        body = protocol.encode(
+            protocol.RpcResponse(exceptions.ServerBusy('busy')), 'json')
+        decoded = protocol.decode(body)
+        self.assertIsInstance(decoded.result, exceptions.ServerBusy)
+
+    def test_custom_exception_dict(self):
+        class CustomError(Exception):
+            pass
+        body = protocol.encode(
+            protocol.RpcResponse(CustomError('custom', None)), 'json')
+        self.assertEqual(body['exception']['args'], ['custom', None])
+        decoded = protocol.decode(body)
+        self.assertIsInstance(decoded.result, exceptions.RemoteError)
+        self.assertTrue(decoded.result.exc_type.endswith('.CustomError'))
+
+    def test_decode_unknown_body(self):
+        self.assertEqual(protocol.decode({'foo': 1}), {'foo': 1})
+        self.assertEqual(protocol.decode('foo'), 'foo')
+
+
+class TestRpcBatch(test.TestCase):
+
+    def test_batch_request_dict(self):
+        batch = protocol.RpcBatchRequest([
+            protocol.RpcRequest('f', [1], {}),
+            protocol.RpcRequest('g', [], {'a': 2})])
+        decoded = protocol.decode(protocol.encode(batch, 'json'))
+        self.assertIsInstance(decoded, protocol.RpcBatchRequest)
+        self.assertEqual([r.func_name for r in decoded.requests], ['f', 'g'])
+        self.assertEqual(decoded.requests[1].func_kwargs, {'a': 2})
+
+    def test_batch_response_dict(self):
+        batch = protocol.RpcBatchResponse([
+            protocol.RpcResponse(1),
+            protocol.RpcResponse(ValueError('test'))])
+        decoded = protocol.decode(protocol.encode(batch, 'json'))
+        self.assertIsInstance(decoded, protocol.RpcBatchResponse)
+        self.assertEqual(decoded.responses[0].result, 1)
+        self.assertIsInstance(decoded.responses[1].result, ValueError)
+
+    def test_stream_chunk_dict(self):
+        chunk = protocol.RpcStreamChunk([1, 2], end=True)
+        decoded = protocol.decode(protocol.encode(chunk, 'json'))
+        self.assertIsInstance(decoded, protocol.RpcStreamChunk)
+        self.assertEqual(decoded.items, [1, 2])
+        self.assertTrue(decoded.end)
+
+    def test_request_upload_dict(self):
+        request = protocol.RpcRequest(
+            'f', [protocol.RpcUpload('up1', True)],
+            {'f': protocol.RpcUpload('up2', False)})
+        decoded = protocol.decode(protocol.encode(request, 'json'))
+        self.assertEqual(decoded.func_args[0].upload_id, 'up1')
+        self.assertTrue(decoded.func_args[0].binary)
+        self.assertEqual(decoded.func_kwargs['f'].upload_id, 'up2')
+        self.assertFalse(decoded.func_kwargs['f'].binary)
+
+    def test_request_upload_shaped_dict(self):
+        for arg in ({'type': 'upload'},
+                    {'type': 'upload', 'upload_id': 'up1', 'binary': True}):
+            request = protocol.RpcRequest('f', [arg], {'f': arg})
+            for serializer in ('json', 'msgpack'):
+                decoded = protocol.decode(protocol.encode(request,
+                                                          serializer))
+                self.assertEqual(decoded.func_args, [arg])
+                self.assertEqual(decoded.func_kwargs, {'f': arg})
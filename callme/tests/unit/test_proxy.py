@@ -31,6 +31,16 @@
 
 # pylint: disable=W0212
 
+import io
+import pickle
+import time
+from concurrent import futures
+
+import mock
+
+from callme import cache
+from callme import exceptions as exc
+from callme import protocol as pr
 from callme import proxy
 from callme import test
 
@@ -63,3 +73,423 @@ class TestProxy(test.MockTestCase):
         s.use_server('test_server', 30)
         self.assertEqual(s._server_id, 'test_server')
         self.assertEqual(s._timeout, 30)
+
+    def test_on_response_resolves_pending_future(self):
+        s = proxy.Proxy('fooserver')
+        first = proxy.RpcFuture(s, 'corr1', 60)
+        second = proxy.RpcFuture(s, 'corr2', 60)
+        s._pending = {'corr1': first, 'corr2': second}
+        message = mock.Mock(properties={'correlation_id': 'corr2'})
+
+        s._on_response(pr.RpcResponse('result'), message)
+
+        message.ack.assert_called_once_with()
+        self.assertFalse(first.done())
+        self.assertTrue(second.done())
+        self.assertEqual(second.result(), 'result')
+        self.assertEqual(list(s._pending), ['corr1'])
+
+    def test_on_response_unknown_correlation_id(self):
+        s = proxy.Proxy('fooserver')
+        future = proxy.RpcFuture(s, 'corr1', 60)
+        s._pending = {'corr1': future}
+        message = mock.Mock(properties={'correlation_id': 'stale'})
+
+        s._on_response(pr.RpcResponse('result'), message)
+
+        message.ack.assert_called_once_with()
+        self.assertFalse(future.done())
+        self.assertEqual(list(s._pending), ['corr1'])
+
+    def test_on_response_exception(self):
+        s = proxy.Proxy('fooserver')
+        future = proxy.RpcFuture(s, 'corr1', 60)
+        s._pending = {'corr1': future}
+        message = mock.Mock(properties={'correlation_id': 'corr1'})
+
+        s._on_response(pr.RpcResponse(ValueError('test')), message)
+
+        self.assertIsInstance(future.exception(), ValueError)
+        self.assertRaises(ValueError, future.result)
+
+    def test_on_response_call_info(self):
+        infos = []
+        s = proxy.Proxy('fooserver', call_info_callback=infos.append)
+        future = proxy.RpcFuture(s, 'corr1', 60)
+        s._pending = {'corr1': future}
+        message = mock.Mock(properties={'correlation_id': 'corr1'},
+                            headers={pr.SENT: 1.0, pr.RECEIVED: 1.5,
+                                     pr.STARTED: 2.0, pr.FINISHED: 4.0})
+
+        s._on_response(pr.RpcResponse('result'), message)
+
+        info = future.call_info
+        self.assertEqual(infos, [info])
+        self.assertEqual(info.correlation_id, 'corr1')
+        self.assertEqual((info.sent, info.finished), (1.0, 4.0))
+
+    def test_call_info(self):
+        info = proxy.CallInfo.from_headers(
+            {pr.SENT: 1.0, pr.RECEIVED: 1.5, pr.STARTED: 2.0,
+             pr.FINISHED: 4.0}, 'corr1', 4.5)
+        self.assertEqual((info.queued, info.backlog, info.execution,
+                          info.transit, info.total),
+                         (0.5, 0.5, 2.0, 0.5, 3.5))
+        self.assertIsNone(proxy.CallInfo.from_headers(
+            {pr.SENT: 1.0}, 'corr1', 4.5))
+
+    def test_on_response_without_call_info(self):
+        s = proxy.Proxy('fooserver', call_info_callback=mock.Mock())
+        future = proxy.RpcFuture(s, 'corr1', 60)
+        s._pending = {'corr1': future}
+        message = mock.Mock(properties={'correlation_id': 'corr1'},
+                            headers={})
+
+        s._on_response(pr.RpcResponse('result'), message)
+
+        self.assertEqual(future.result(), 'result')
+        self.assertIsNone(future.call_info)
+        self.assertFalse(s._call_info_callback.called)
+
+    def test_call_async_returns_future(self):
+        s = proxy.Proxy('fooserver')
+        with mock.patch.object(proxy.kombu, 'producers'):
+            future = s.call_async.foo.bar(1, b=2)
+        self.assertIsInstance(future, proxy.RpcFuture)
+        self.assertFalse(future.done())
+        self.assertIs(s._pending[future.correlation_id], future)
+
+    def test_future_timeout(self):
+        s = proxy.Proxy('fooserver', timeout=1)
+        future = proxy.RpcFuture(s, 'corr1', 1)
+        s._pending = {'corr1': future}
+        future.deadline = 0
+
+        self.assertRaises(exc.RpcTimeout, future.result)
+        self.assertEqual(s._pending, {})
+
+    def test_future_result_wait_timeout(self):
+        s = proxy.Proxy('fooserver')
+        future = proxy.RpcFuture(s, 'corr1', 60)
+        s._pending = {'corr1': future}
+
+        self.assertRaises(futures.TimeoutError, future.result, 0)
+        self.assertIs(s._pending['corr1'], future)
+
+    def test_gather(self):
+        s = proxy.Proxy('fooserver')
+        fs = [proxy.RpcFuture(s, 'corr{0}'.format(i), 60) for i in range(3)]
+        fs[0].set_response(pr.RpcResponse('a'))
+        fs[1].set_response(pr.RpcResponse(ValueError('b')))
+        fs[2].set_response(pr.RpcResponse('c'))
+
+        results = proxy.gather(fs, return_exceptions=True)
+        self.assertEqual(results[0], 'a')
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(results[2], 'c')
+        self.assertRaises(ValueError, proxy.gather, fs)
+
+    def test_as_completed(self):
+        s = proxy.Proxy('fooserver')
+        first = proxy.RpcFuture(s, 'corr1', 60)
+        second = proxy.RpcFuture(s, 'corr2', 60)
+        s._pending = {'corr1': first, 'corr2': second}
+        second.set_response(pr.RpcResponse('b'))
+
+        completed = proxy.as_completed([first, second], timeout=0)
+        self.assertIs(next(completed), second)
+        self.assertRaises(futures.TimeoutError, next, completed)
+
+    def test_direct_reply_to(self):
+        queue_mock, _ = self._mock_class(proxy.kombu, 'Queue')
+        producer_mock, producer_inst_mock = self._mock_class(
+            proxy.kombu, 'Producer')
+
+        s = proxy.Proxy('fooserver', direct_reply_to=True)
+
+        queue_mock.assert_called_once_with('amq.rabbitmq.reply-to',
+                                           no_ack=True)
+        consumer_kwargs = self.consumer_mock.call_args[1]
+        self.assertTrue(consumer_kwargs['no_ack'])
+        self.assertFalse(consumer_kwargs['auto_declare'])
+
+        with mock.patch.object(s, '_publish') as publish:
+            s.call_async.foo()
+        producer, = publish.call_args[0]
+        self.assertIs(producer, producer_inst_mock)
+        self.assertEqual(publish.call_args[1]['reply_to'],
+                         'amq.rabbitmq.reply-to')
+
+    def test_publish_request_deadline(self):
+        s = proxy.Proxy('fooserver', timeout=30)
+        with mock.patch.object(s, '_publish') as publish:
+            with mock.patch.object(proxy.kombu, 'producers'):
+                future = s.call_async.foo()
+        kwargs = publish.call_args[1]
+        self.assertEqual(kwargs['headers'][pr.DEADLINE], future.deadline)
+        self.assertTrue(0 < kwargs['expiration'] <= 30)
+
+    def test_publish_request_without_deadline(self):
+        s = proxy.Proxy('fooserver', timeout=0)
+        with mock.patch.object(s, '_publish') as publish:
+            with mock.patch.object(proxy.kombu, 'producers'):
+                s.call_async.foo()
+        kwargs = publish.call_args[1]
+        self.assertNotIn(pr.DEADLINE, kwargs['headers'])
+        self.assertNotIn('expiration', kwargs)
+
+    def test_batch(self):
+        s = proxy.Proxy('fooserver')
+        batch = s.start_batch()
+        batch.madd(1, 2)
+        batch.foo.bar(b=3)
+        self.assertEqual(len(batch), 2)
+
+        with mock.patch.object(s, '_publish_request') as publish:
+            future = batch.send()
+        self.assertEqual(publish.call_count, 1)
+        request = pr.decode(pickle.loads(publish.call_args[1]['body']))
+        self.assertIsInstance(request, pr.RpcBatchRequest)
+        self.assertEqual([r.func_name for r in request.requests],
+                         ['madd', 'foo.bar'])
+
+        message = mock.Mock(properties={
+            'correlation_id': future.correlation_id})
+        s._on_response(pr.RpcBatchResponse([
+            pr.RpcResponse(3), pr.RpcResponse(ValueError('test'))]), message)
+        results = proxy.BatchResults(future.result())
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0], 3)
+        self.assertRaises(ValueError, results.__getitem__, 1)
+
+    def test_coalesce_max_calls(self):
+        s = proxy.Proxy('fooserver', coalesce_window=60, coalesce_max=2)
+        with mock.patch.object(s, '_publish_request') as publish:
+            first = s.call_async.madd(1, 2)
+            self.assertEqual(publish.call_count, 0)
+            second = s.call_async.foo()
+        self.assertEqual(publish.call_count, 1)
+        request = pr.decode(pickle.loads(publish.call_args[1]['body']))
+        self.assertIsInstance(request, pr.RpcBatchRequest)
+        self.assertEqual([r.func_name for r in request.requests],
+                         ['madd', 'foo'])
+
+        message = mock.Mock(properties={
+            'correlation_id': publish.call_args[1]['correlation_id']})
+        s._on_response(pr.RpcBatchResponse([
+            pr.RpcResponse(3), pr.RpcResponse(ValueError('test'))]), message)
+        self.assertEqual(first.result(), 3)
+        self.assertRaises(ValueError, second.result)
+        self.assertEqual(s._pending, {})
+
+    def test_coalesce_flush(self):
+        s = proxy.Proxy('fooserver', coalesce_window=60)
+        with mock.patch.object(s, '_publish_request') as publish:
+            s.call_async.foo()
+            s.use_server('barserver')
+            s.call_async.bar()
+            self.assertEqual(publish.call_count, 0)
+            s.flush_calls()
+        self.assertEqual(publish.call_count, 2)
+        self.assertEqual(
+            sorted(kwargs['exchange'].name
+                   for _, kwargs in publish.call_args_list),
+            ['server_barserver_ex', 'server_fooserver_ex'])
+
+    def test_coalesce_expired_batch(self):
+        s = proxy.Proxy('fooserver', coalesce_window=60)
+        with mock.patch.object(s, '_publish_request'):
+            future = s.call_async.foo()
+            s.flush_calls()
+        future.expire(future.deadline)
+        self.assertRaises(exc.RpcTimeout, future.result)
+        self.assertEqual(s._pending, {})
+
+    def test_coalesce_publishes_earliest_deadline(self):
+        s = proxy.Proxy('fooserver', coalesce_window=60, timeout=1)
+        with mock.patch.object(s, '_publish_request') as publish:
+            first = s.call_async.foo()
+            s.use_server(timeout=60)
+            s.call_async.bar()
+            s.flush_calls()
+        deadline = publish.call_args[1]['deadline']
+        self.assertTrue(deadline <= first.deadline + 0.01)
+
+    def test_stream(self):
+        s = proxy.Proxy('fooserver')
+        future = proxy.RpcFuture(s, 'corr1', 60)
+        s._pending = {'corr1': future}
+        message = mock.Mock(properties={'correlation_id': 'corr1'})
+
+        s._on_response(pr.RpcStreamChunk([0, 1]), message)
+        stream = future.result()
+        self.assertIsInstance(stream, proxy.ResultStream)
+        self.assertEqual(s._pending, {'corr1': future})
+        s._on_response(pr.RpcStreamChunk([2], end=True), message)
+        self.assertEqual(s._pending, {})
+        self.assertEqual(list(stream), [0, 1, 2])
+
+    def test_stream_error(self):
+        s = proxy.Proxy('fooserver')
+        future = proxy.RpcFuture(s, 'corr1', 60)
+        s._pending = {'corr1': future}
+        message = mock.Mock(properties={'correlation_id': 'corr1'})
+
+        s._on_response(pr.RpcStreamChunk([0]), message)
+        s._on_response(pr.RpcResponse(ValueError('test')), message)
+        stream = future.result()
+        self.assertEqual(next(stream), 0)
+        self.assertRaises(ValueError, next, stream)
+
+    def test_stream_timeout(self):
+        s = proxy.Proxy('fooserver')
+        future = proxy.RpcFuture(s, 'corr1', 60)
+        s._pending = {'corr1': future}
+        message = mock.Mock(properties={'correlation_id': 'corr1'})
+
+        s._on_response(pr.RpcStreamChunk([0]), message)
+        stream = future.result()
+        self.assertTrue(future.expire(future.deadline))
+        self.assertEqual(next(stream), 0)
+        self.assertRaises(exc.RpcTimeout, next, stream)
+
+    def test_upload(self):
+        s = proxy.Proxy('fooserver', upload_chunk_size=4)
+        published = []
+
+        def publish(**kwargs):
+            published.append(kwargs)
+            if 'correlation_id' in kwargs and kwargs.get('type'):
+                s._pending.pop(kwargs['correlation_id']).set_response(
+                    pr.RpcResponse('instance_key'))
+
+        with mock.patch.object(s, '_publish_request', side_effect=publish):
+            s.call_async.up(b'0123456789', b'abc', f=io.BytesIO(b'abcde'))
+
+        chunks = published[:-1]
+        self.assertEqual([c['body'] for c in chunks],
+                         [b'0123', b'4567', b'89', b'abcd', b'e'])
+        self.assertTrue(all(c['type'] == pr.UPLOAD_CHUNK for c in chunks))
+        self.assertNotIn('routing_key', chunks[0])
+        self.assertTrue(all(c['routing_key'] == 'instance_key'
+                            for c in chunks[1:]))
+        self.assertEqual(len(set(c['message_id'] for c in chunks)), 2)
+
+        request = published[-1]
+        self.assertEqual(request['routing_key'], 'instance_key')
+        request = pr.decode(pickle.loads(request['body']))
+        self.assertTrue(request.func_args[0].binary)
+        self.assertFalse(request.func_kwargs['f'].binary)
+        self.assertEqual(request.func_args[1], b'abc')
+
+    def test_cache(self):
+        s = proxy.Proxy('fooserver')
+        s.set_cache('config.get', cache.ResultCache())
+
+        with mock.patch.object(s, '_publish_request') as publish:
+            future = s.call_async.config.get('key')
+            message = mock.Mock(properties={
+                'correlation_id': future.correlation_id})
+            s._on_response(pr.RpcResponse('value'), message)
+            self.assertEqual(future.result(), 'value')
+            self.assertEqual(s.config.get('key'), 'value')
+            self.assertEqual(publish.call_count, 1)
+
+            future = s.call_async.config.get('other')
+            s._on_response(pr.RpcResponse(ValueError('test')), mock.Mock(
+                properties={'correlation_id': future.correlation_id}))
+            self.assertRaises(ValueError, future.result)
+        self.assertEqual(s.get_cache('config.get').stats()['size'], 1)
+
+    def test_cache_bypass(self):
+        s = proxy.Proxy('fooserver')
+        s.set_cache('config.get', cache.ResultCache())
+        s.get_cache('config.get').put(('key',), {}, 'old')
+
+        def publish(**kwargs):
+            message = mock.Mock(properties={
+                'correlation_id': kwargs['correlation_id']})
+            s._on_response(pr.RpcResponse('new'), message)
+
+        with mock.patch.object(s, '_publish_request', side_effect=publish):
+            self.assertEqual(s.config.get('key'), 'old')
+            self.assertEqual(s.no_cache.config.get('key'), 'new')
+        self.assertEqual(s.config.get('key'), 'new')
+
+    def test_scatter_publishes_shared_deadline(self):
+        s = proxy.Proxy('fooserver', timeout=60)
+        self.conn_inst_mock.drain_events.side_effect = (
+            lambda timeout: time.sleep(timeout))
+
+        with mock.patch.object(s, '_publish_request') as publish:
+            before = time.time()
+            s.scatter(['shard1'], timeout=0.1).count('foo')
+
+        self.assertTrue(publish.call_args[1]['deadline'] <= before + 0.2)
+
+    def test_scatter(self):
+        s = proxy.Proxy('fooserver')
+        self.conn_inst_mock.drain_events.side_effect = (
+            lambda timeout: time.sleep(timeout))
+
+        def publish(**kwargs):
+            server_id = kwargs['exchange'].name.split('_')[1]
+            if server_id == 'shard3':
+                raise IOError('test')
+            if server_id == 'shard1':
+                message = mock.Mock(properties={
+                    'correlation_id': kwargs['correlation_id']})
+                s._on_response(pr.RpcResponse(5), message)
+
+        with mock.patch.object(s, '_publish_request', side_effect=publish):
+            results = s.scatter(['shard1', 'shard2', 'shard3'],
+                                timeout=0.1).count('foo')
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results.results, {'shard1': 5})
+        self.assertEqual(results['shard1'], 5)
+        self.assertEqual(results.timeouts, ['shard2'])
+        self.assertRaises(exc.RpcTimeout, results.__getitem__, 'shard2')
+        self.assertIsInstance(results.errors['shard3'], IOError)
+        self.assertEqual(s._pending, {})
+
+    def test_broadcast_expected(self):
+        s = proxy.Proxy('fooserver')
+
+        def publish(**kwargs):
+            message = mock.Mock(properties={
+                'correlation_id': kwargs['correlation_id']})
+            s._on_response(pr.RpcResponse(1), message)
+            s._on_response(pr.RpcResponse(ValueError('test')), message)
+
+        with mock.patch.object(s, '_publish_request',
+                               side_effect=publish) as publish_request:
+            results = s.broadcast(timeout=None, expected=2).stats()
+
+        exchange = publish_request.call_args[1]['exchange']
+        self.assertEqual(exchange.name, 'server_fooserver_broadcast_ex')
+        self.assertEqual(exchange.type, 'fanout')
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results.results, [1])
+        self.assertIsInstance(results.errors[0], ValueError)
+        self.assertEqual(s._pending, {})
+
+    def test_broadcast_timeout(self):
+        s = proxy.Proxy('fooserver')
+        self.conn_inst_mock.drain_events.side_effect = (
+            lambda timeout: time.sleep(timeout))
+
+        def publish(**kwargs):
+            message = mock.Mock(properties={
+                'correlation_id': kwargs['correlation_id']})
+            s._on_response(pr.RpcResponse(1), message)
+
+        with mock.patch.object(s, '_publish_request', side_effect=publish):
+            results = s.broadcast(timeout=0.1).stats()
+
+        self.assertEqual(list(results), [1])
+        self.assertEqual(s._pending, {})
+
+    def test_broadcast_requires_limit(self):
+        s = proxy.Proxy('fooserver')
+        self.assertRaises(ValueError, s.broadcast, timeout=None)
@@ -31,6 +31,18 @@
 
 # pylint: disable=W0212
 
+import json
+import threading
+import time
+
+from concurrent import futures
+import mock
+
+from callme import cache
+from callme import exceptions as exc
+from callme import metrics
+from callme import profiling
+from callme import protocol as pr
 from callme import server
 from callme import test
 
@@ -77,3 +89,564 @@ class TestServer(test.MockTestCase):
     def test_register_function_not_callable(self):
         s = server.Server('fooserver')
         self.assertRaises(ValueError, s.register_function, 1)
+
+    def test_invalid_backlog_policy(self):
+        self.assertRaises(ValueError, server.Server, 'fooserver',
+                          backlog_policy='drop')
+
+    def test_threaded_request_uses_worker_pool(self):
+        s = server.Server('fooserver', threaded=True, max_workers=2)
+        s._executor = futures.ThreadPoolExecutor(2)
+        self.addCleanup(s._executor.shutdown)
+        request = pr.RpcRequest('func', [], {})
+        message = mock.Mock()
+        done = threading.Event()
+
+        with mock.patch.object(s, '_process_request',
+                               side_effect=lambda *a: done.set()) as process:
+            s._on_request(request, message)
+            self.assertTrue(done.wait(5))
+        process.assert_called_once_with(request, message, mock.ANY)
+
+    def test_full_backlog_reject(self):
+        s = server.Server('fooserver', threaded=True, max_workers=1,
+                          max_backlog=0, backlog_policy='reject')
+        s._executor = mock.Mock()
+        self.assertTrue(s._slots.acquire(False))
+        request = pr.RpcRequest('func', [], {})
+        message = mock.Mock(properties={'correlation_id': 'corr1',
+                                        'reply_to': 'client_ex'})
+
+        with mock.patch.object(s, '_publish_response') as publish:
+            s._on_request(request, message)
+
+        self.assertFalse(s._executor.submit.called)
+        response, reply_to, correlation_id, _ = publish.call_args[0]
+        self.assertIsInstance(response.result, exc.ServerBusy)
+        self.assertEqual(reply_to, 'client_ex')
+        self.assertEqual(correlation_id, 'corr1')
+
+    def test_register_function_use_process(self):
+        def func():
+            pass
+        s = server.Server('fooserver')
+        s.register_function(func, 'proc', use_process=True)
+        s.register_function(func, 'thread')
+        self.assertEqual(s._process_funcs, set(['proc']))
+
+    def test_register_function_use_processes_default(self):
+        def func():
+            pass
+        s = server.Server('fooserver', use_processes=True)
+        s.register_function(func, 'proc')
+        s.register_function(func, 'thread', use_process=False)
+        self.assertEqual(s._process_funcs, set(['proc']))
+
+    def test_process_request_publishes_from_server(self):
+        s = server.Server('fooserver')
+        s.register_function(divmod, 'divmod', use_process=True)
+        s._process_executor = futures.ThreadPoolExecutor(1)
+        self.addCleanup(s._process_executor.shutdown)
+        message = mock.Mock(properties={'correlation_id': 'corr1',
+                                        'reply_to': 'client_ex'})
+        published = threading.Event()
+
+        with mock.patch.object(s, '_publish_response',
+                               side_effect=lambda *a, **kw: published.set()
+                               ) as p:
+            s._on_request(pr.RpcRequest('divmod', [1, 0], {}), message)
+            self.assertTrue(published.wait(5))
+
+        response, reply_to, correlation_id, _ = p.call_args[0]
+        self.assertIsInstance(response.result, ZeroDivisionError)
+        self.assertEqual((reply_to, correlation_id), ('client_ex', 'corr1'))
+
+    def test_ack_on_receipt(self):
+        s = server.Server('fooserver')
+        message = mock.Mock(properties={'correlation_id': 'corr1',
+                                        'reply_to': 'client_ex'})
+
+        with mock.patch.object(s, '_publish_response'):
+            s._on_request(pr.RpcRequest('func', [], {}), message)
+
+        message.ack.assert_called_once_with()
+        self.assertTrue(s._acks.empty())
+
+    def test_ack_late(self):
+        s = server.Server('fooserver', ack_late=True)
+        message = mock.Mock(properties={'correlation_id': 'corr1',
+                                        'reply_to': 'client_ex'})
+
+        with mock.patch.object(s, '_publish_response') as publish:
+            publish.side_effect = lambda *a, **kw: self.assertFalse(
+                message.ack.called)
+            s._on_request(pr.RpcRequest('func', [], {}), message)
+
+        self.assertTrue(publish.called)
+        self.assertFalse(message.ack.called)
+        self.assertEqual(s._unacked, 1)
+        s._flush_acks()
+        message.ack.assert_called_once_with()
+        self.assertEqual(s._unacked, 0)
+
+    def test_process_request_timing_headers(self):
+        s = server.Server('fooserver')
+        s.register_function(lambda: 'result', 'func')
+        message = mock.Mock(properties={'correlation_id': 'corr1',
+                                        'reply_to': 'client_ex'},
+                            headers={pr.SENT: 1.0})
+
+        with mock.patch.object(s, '_publish_response') as publish:
+            s._on_request(pr.RpcRequest('func', [], {}), message)
+
+        headers = publish.call_args[1]['headers']
+        self.assertEqual(headers[pr.SENT], 1.0)
+        self.assertTrue(headers[pr.RECEIVED] <= headers[pr.STARTED] <=
+                        headers[pr.FINISHED])
+
+    def test_start_prefetch_count(self):
+        s = server.Server('fooserver', prefetch_count=5)
+        with mock.patch.object(server.kombu, 'connections') as connections:
+            conn = connections[s._conn].acquire.return_value.__enter__()
+            conn.drain_events.side_effect = lambda timeout: s.stop()
+            s.start()
+
+        self.assertEqual(conn.Consumer.call_args[1]['prefetch_count'], 5)
+
+    def test_publish_response_direct_reply_to(self):
+        s = server.Server('fooserver')
+        response = pr.RpcResponse('result')
+        reply_to = 'amq.rabbitmq.reply-to.g2dkAA'
+
+        with mock.patch.object(server.kombu, 'producers') as producers:
+            with mock.patch.object(s, '_publish') as publish:
+                s._publish_response(response, reply_to, 'corr1')
+
+        producer = producers[s._conn].acquire.return_value.__enter__()
+        self.assertEqual(publish.call_args[0], (producer,))
+        kwargs = publish.call_args[1]
+        self.assertEqual(kwargs['declare'], [])
+        self.assertEqual(kwargs['exchange'], '')
+        self.assertEqual(kwargs['routing_key'], reply_to)
+        self.assertEqual(kwargs['correlation_id'], 'corr1')
+        self.assertFalse(self.exchange_mock.called)
+
+    def test_respond_with_request_serializer(self):
+        s = server.Server('fooserver')
+        message = mock.Mock(properties={'correlation_id': 'corr1',
+                                        'reply_to': 'client_ex'},
+                            content_type='application/json')
+        request = pr.encode(pr.RpcRequest('func', [], {}), 'json')
+
+        with mock.patch.object(s, '_publish_response') as publish:
+            s._on_request(request, message)
+
+        response, reply_to, correlation_id, serializer = (
+            publish.call_args[0])
+        self.assertIsInstance(response.result, KeyError)
+        self.assertEqual(serializer, 'json')
+
+    def test_execute_batch(self):
+        s = server.Server('fooserver')
+        s.register_function(lambda a, b: a + b, 'madd')
+        batch = pr.RpcBatchRequest([pr.RpcRequest('madd', [1, 2], {}),
+                                    pr.RpcRequest('missing', [], {}),
+                                    pr.RpcRequest('madd', [3], {'b': 4})])
+
+        response = s._execute(batch)
+
+        self.assertIsInstance(response, pr.RpcBatchResponse)
+        self.assertEqual(response.responses[0].result, 3)
+        self.assertIsInstance(response.responses[1].result, KeyError)
+        self.assertEqual(response.responses[2].result, 7)
+
+    def test_process_request_stream(self):
+        def numbers(n):
+            for i in range(n):
+                yield i
+            raise ValueError('test')
+
+        s = server.Server('fooserver', stream_chunk_size=2)
+        s.register_function(numbers, 'numbers')
+        message = mock.Mock(properties={'correlation_id': 'corr1',
+                                        'reply_to': 'client_ex'})
+
+        with mock.patch.object(s, '_publish_response') as publish:
+            s._on_request(pr.RpcRequest('numbers', [3], {}), message)
+
+        responses = [args[0] for args, _ in publish.call_args_list]
+        self.assertEqual([r.items for r in responses[:2]], [[0, 1], [2]])
+        self.assertFalse(any(r.end for r in responses[:2]))
+        self.assertIsInstance(responses[2].result, ValueError)
+
+    def test_execute_batch_collects_generator(self):
+        s = server.Server('fooserver')
+        s.register_function(lambda n: (i for i in range(n)), 'numbers')
+        batch = pr.RpcBatchRequest([pr.RpcRequest('numbers', [3], {})])
+
+        response = s._execute(batch)
+
+        self.assertEqual(response.responses[0].result, [0, 1, 2])
+
+    def test_upload(self):
+        s = server.Server('fooserver')
+        s.register_function(lambda data, f: (data, f.read()), 'up')
+        first = mock.Mock(properties={'type': pr.UPLOAD_CHUNK,
+                                      'message_id': 'up1',
+                                      'correlation_id': 'corr1',
+                                      'reply_to': 'client_ex'},
+                          content_type='application/data')
+        second = mock.Mock(properties={'type': pr.UPLOAD_CHUNK,
+                                       'message_id': 'up1'})
+        third = mock.Mock(properties={'type': pr.UPLOAD_CHUNK,
+                                      'message_id': 'up2'})
+        message = mock.Mock(properties={'correlation_id': 'corr2',
+                                        'reply_to': 'client_ex'})
+        request = pr.RpcRequest('up', [pr.RpcUpload('up1', True)],
+                                {'f': pr.RpcUpload('up2', False)})
+
+        with mock.patch.object(s, '_publish_response') as publish:
+            s._on_request(b'foo', first)
+            s._on_request(b'bar', second)
+            s._on_request(b'baz', third)
+            s._on_request(request, message)
+
+        (ack, _, correlation_id, serializer), _ = publish.call_args_list[0]
+        self.assertEqual(ack.result, s._instance_key)
+        self.assertEqual((correlation_id, serializer), ('corr1', 'pickle'))
+        self.assertEqual(publish.call_count, 2)
+        self.assertEqual(publish.call_args[0][0].result, (b'foobar', b'baz'))
+        self.assertEqual(s._uploads, {})
+
+    def test_malformed_request(self):
+        s = server.Server('fooserver')
+        message = mock.Mock(properties={'correlation_id': 'corr1',
+                                        'reply_to': 'client_ex'},
+                            content_type='application/json')
+
+        with mock.patch.object(s, '_publish_response') as publish:
+            s._on_request({'type': 'request', 'func_name': 'f'}, message)
+            s._on_request(b'foo', mock.Mock(properties={}))
+
+        self.assertEqual(publish.call_count, 1)
+        response, reply_to, correlation_id, serializer = (
+            publish.call_args[0])
+        self.assertIsInstance(response.result, ValueError)
+        self.assertEqual((reply_to, correlation_id, serializer),
+                         ('client_ex', 'corr1', 'json'))
+
+    def test_upload_missing(self):
+        s = server.Server('fooserver')
+        s.register_function(lambda data: data, 'up')
+        message = mock.Mock(properties={'correlation_id': 'corr1',
+                                        'reply_to': 'client_ex'})
+        request = pr.RpcRequest('up', [pr.RpcUpload('up1', True)], {})
+
+        with mock.patch.object(s, '_publish_response') as publish:
+            s._on_request(request, message)
+
+        self.assertIsInstance(publish.call_args[0][0].result, ValueError)
+
+    def test_execute_cached(self):
+        func = mock.Mock(return_value=3)
+        s = server.Server('fooserver')
+        s.register_function(func, 'madd', cache=cache.ResultCache())
+        request = pr.RpcRequest('madd', [1, 2], {})
+
+        self.assertEqual(s._execute(request).result, 3)
+        self.assertEqual(s._execute(request).result, 3)
+        self.assertEqual(func.call_count, 1)
+
+        s.get_cache('madd').invalidate(1, 2)
+        s._execute(request)
+        self.assertEqual(func.call_count, 2)
+
+    def test_execute_cached_exception(self):
+        func = mock.Mock(side_effect=ValueError('test'))
+        s = server.Server('fooserver')
+        s.register_function(func, 'func', cache=cache.ResultCache())
+        request = pr.RpcRequest('func', [], {})
+
+        s._execute(request)
+        s._execute(request)
+        self.assertEqual(func.call_count, 2)
+        self.assertEqual(len(s.get_cache('func')), 0)
+
+    def test_execute_single_flight(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def func(a):
+            calls.append(a)
+            started.set()
+            release.wait(5)
+            return a * 2
+
+        s = server.Server('fooserver', single_flight=True)
+        s.register_function(func, 'func')
+        request = pr.RpcRequest('func', [21], {})
+        executor = futures.ThreadPoolExecutor(2)
+        self.addCleanup(executor.shutdown)
+
+        joined = threading.Event()
+
+        class Flight(futures.Future):
+            def result(self, timeout=None):
+                joined.set()
+                return super(Flight, self).result(timeout)
+
+        with mock.patch.object(server.futures, 'Future', Flight):
+            leader = executor.submit(s._execute, request)
+            self.assertTrue(started.wait(5))
+            follower = executor.submit(s._execute, request)
+            self.assertTrue(joined.wait(5))
+            release.set()
+
+        self.assertEqual(leader.result(5).result, 42)
+        self.assertEqual(follower.result(5).result, 42)
+        self.assertEqual(calls, [21])
+        self.assertEqual(s._flights, {})
+
+    def test_single_flight_across_process_and_batch(self):
+        release = threading.Event()
+        s = server.Server('fooserver')
+        s.register_function(lambda a: release.wait(5) and a, 'func',
+                            use_process=True, single_flight=True)
+        s._process_executor = futures.ThreadPoolExecutor(2)
+        self.addCleanup(s._process_executor.shutdown)
+        executor = futures.ThreadPoolExecutor(1)
+        self.addCleanup(executor.shutdown)
+        message = mock.Mock(properties={'correlation_id': 'corr1',
+                                        'reply_to': 'client_ex'})
+        request = pr.RpcRequest('func', [1], {})
+        batch = pr.RpcBatchRequest([pr.RpcRequest('func', [1], {})])
+
+        with mock.patch.object(s, '_publish_response') as publish:
+            # a batch entry joins the execution in a worker process
+            flight = s._submit_to_processes(request, message)
+            joined = executor.submit(s._execute, batch)
+            time.sleep(0.05)
+            release.set()
+            self.assertEqual(joined.result(5).responses[0].result, 1)
+            flight.result(5)
+
+            # a process request joins the execution of a batch entry
+            release.clear()
+            leader = executor.submit(s._execute, batch)
+            while not s._flights:
+                time.sleep(0.01)
+            flight = s._submit_to_processes(request, message)
+            release.set()
+            leader.result(5)
+            flight.result(5)
+
+        responses = [args[0] for args, _ in publish.call_args_list]
+        self.assertEqual([r.result for r in responses], [1, 1])
+        self.assertEqual(s._flights, {})
+
+    def test_submit_to_processes_single_flight(self):
+        release = threading.Event()
+        s = server.Server('fooserver')
+        s.register_function(lambda a: release.wait(5) and a, 'func',
+                            use_process=True, single_flight=True)
+        s._process_executor = futures.ThreadPoolExecutor(2)
+        self.addCleanup(s._process_executor.shutdown)
+        messages = [mock.Mock(properties={'correlation_id': corr_id,
+                                          'reply_to': 'client_ex'})
+                    for corr_id in ('corr1', 'corr2')]
+        request = pr.RpcRequest('func', [1], {})
+
+        s._consuming = True
+
+        with mock.patch.object(s, '_publish_response') as publish:
+            first = s._submit_to_processes(request, messages[0])
+            second = s._submit_to_processes(request, messages[1])
+            self.assertEqual(len(s._flights), 1)
+            release.set()
+            while s._responses.qsize() < 2:
+                time.sleep(0.01)
+            # the responses are published by the consumer thread
+            self.assertFalse(publish.called)
+            self.assertFalse(first.done())
+            s._flush_responses()
+            first.result(0)
+            second.result(0)
+
+        self.assertEqual(sorted(args[2] for args, _ in
+                                publish.call_args_list), ['corr1', 'corr2'])
+        self.assertEqual(s._flights, {})
+        self.assertEqual(s._unpublished, 0)
+
+    def test_flush_responses_survives_failed_publish(self):
+        s = server.Server('fooserver')
+        publish = mock.Mock(side_effect=[Exception('test'), None])
+        s._consuming = True
+        s._publish_later(publish)
+        s._publish_later(publish)
+        s._unpublished = 2
+
+        s._flush_responses()
+
+        self.assertEqual(publish.call_count, 2)
+        self.assertEqual(s._unpublished, 0)
+
+    @mock.patch('concurrent.futures.ProcessPoolExecutor')
+    def test_process_executor_created_on_first_use(self, executor_mock):
+        s = server.Server('fooserver')
+        s.register_function(divmod, 'divmod', use_process=True)
+        message = mock.Mock(properties={'correlation_id': 'corr1',
+                                        'reply_to': 'client_ex'})
+
+        self.assertIsNone(s._process_executor)
+        s._submit_to_processes(pr.RpcRequest('divmod', [7, 2], {}), message)
+        s._submit_to_processes(pr.RpcRequest('divmod', [9, 2], {}), message)
+
+        executor_mock.assert_called_once_with(None)
+        self.assertEqual(executor_mock.return_value.submit.call_count, 2)
+        s._shutdown_executors(wait=False)
+        self.assertIsNone(s._process_executor)
+
+    def test_metrics(self):
+        s = server.Server('fooserver', metrics=metrics.Metrics())
+        s.register_function(divmod, 'divmod')
+        message = mock.Mock(properties={'correlation_id': 'corr1',
+                                        'reply_to': 'client_ex'})
+        message.decode.return_value = pr.encode(
+            pr.RpcRequest('divmod', [1, 0], {}), pr.PICKLE)
+
+        with mock.patch.object(s, '_publish_response') as publish:
+            s._on_message(message)
+            s._on_message(mock.Mock(
+                properties=message.properties,
+                decode=lambda: pr.RpcRequest('unknown', [], {})))
+
+        self.assertEqual(publish.call_count, 2)
+        m = s.metrics
+        self.assertEqual(dict(m.calls), {'divmod': 1})
+        self.assertEqual(dict(m.errors), {'divmod': 1})
+        self.assertEqual(m.decode['divmod'].count, 1)
+        self.assertEqual(m.publish['divmod'].count, 1)
+        self.assertEqual(sorted(m.decode), ['divmod'])
+        self.assertEqual(m.in_flight, 0)
+
+    def test_metrics_gauges(self):
+        hook = mock.Mock(spec=metrics.MetricsHook)
+        s = server.Server('fooserver', threaded=True, metrics=hook)
+        s._executor = futures.ThreadPoolExecutor(1)
+        message = mock.Mock()
+
+        with mock.patch.object(s, '_process_request'):
+            s._on_request(pr.RpcRequest('func', [], {}), message)
+            s._executor.shutdown(wait=True)
+
+        self.assertEqual(hook.set_backlog.call_args_list,
+                         [mock.call(1), mock.call(0)])
+        self.assertEqual(hook.set_in_flight.call_args_list,
+                         [mock.call(1), mock.call(0)])
+
+    def test_profiling_needs_threaded_server(self):
+        self.assertRaises(ValueError, server.Server, 'fooserver',
+                          profiling=True)
+
+    def test_profile_requests(self):
+        s = server.Server('fooserver', threaded=True, profiling=True)
+        self.assertIn(profiling.FUNCTION, s._func_dict)
+        s.register_function(lambda: 'result', 'func')
+        message = mock.Mock(properties={'correlation_id': 'corr1',
+                                        'reply_to': 'client_ex'})
+        executor = futures.ThreadPoolExecutor(1)
+        self.addCleanup(executor.shutdown)
+
+        with mock.patch.object(s, '_publish_response'):
+            future = executor.submit(s.profile_requests, seconds=5, calls=2)
+            while s._profile is None:
+                time.sleep(0.01)
+            self.assertRaises(RuntimeError, s.profile_requests)
+            for _ in range(2):
+                s._process_request(pr.RpcRequest('func', [], {}), message)
+            report = future.result(5)
+
+        self.assertEqual(report['calls'], 2)
+        self.assertIn('_handle_request', report['report'])
+        self.assertIsNone(s._profile)
+
+    def test_drop_expired_request(self):
+        s = server.Server('fooserver', metrics=metrics.Metrics())
+        s.register_function(lambda: 'result', 'func')
+        message = mock.Mock(properties={'correlation_id': 'corr1',
+                                        'reply_to': 'client_ex'},
+                            headers={pr.DEADLINE: time.time() - 1})
+
+        with mock.patch.object(s, '_publish_response') as publish:
+            s._on_request(pr.RpcRequest('func', [], {}), message)
+            s._process_request(pr.RpcRequest('func', [], {}), message)
+
+        self.assertFalse(publish.called)
+        message.ack.assert_called_once_with()
+        self.assertEqual(s.expired_requests, 2)
+        self.assertEqual(dict(s.metrics.expired), {'func': 2})
+        self.assertEqual(dict(s.metrics.calls), {})
+
+    def test_request_before_deadline(self):
+        s = server.Server('fooserver')
+        s.register_function(lambda: 'result', 'func')
+        message = mock.Mock(properties={'correlation_id': 'corr1',
+                                        'reply_to': 'client_ex'},
+                            headers={pr.DEADLINE: time.time() + 60})
+
+        with mock.patch.object(s, '_publish_response') as publish:
+            s._on_request(pr.RpcRequest('func', [], {}), message)
+
+        self.assertEqual(publish.call_args[0][0].result, 'result')
+        self.assertEqual(s.expired_requests, 0)
+
+    def test_publish_response_not_serializable(self):
+        s = server.Server('fooserver')
+
+        with mock.patch.object(server.kombu, 'producers'):
+            with mock.patch.object(s, '_publish') as publish:
+                s._publish_response(pr.RpcResponse(set([1, 2])), 'client_ex',
+                                    'corr1', pr.JSON)
+
+        body = json.loads(publish.call_args[1]['body'])
+        response = pr.decode(body)
+        self.assertIsInstance(response.result, exc.RemoteError)
+        self.assertEqual(response.result.exc_type,
+                         'kombu.exceptions.EncodeError')
+
+    def test_consume_survives_failed_request(self):
+        s = server.Server('fooserver')
+        conn = mock.Mock(connection_errors=(IOError,), channel_errors=())
+        calls = []
+
+        def drain_events(timeout):
+            calls.append(timeout)
+            if len(calls) == 1:
+                raise ValueError('test')
+            s.stop()
+        conn.drain_events.side_effect = drain_events
+
+        s._running.set()
+        s._consume(conn)
+        self.assertEqual(len(calls), 2)
+
+    def test_consume_stops_on_connection_error(self):
+        s = server.Server('fooserver')
+        conn = mock.Mock(connection_errors=(IOError,), channel_errors=())
+        conn.drain_events.side_effect = IOError('test')
+
+        s._running.set()
+        s._consume(conn)
+        self.assertEqual(conn.drain_events.call_count, 1)
+
+    def test_on_message_not_deserializable(self):
+        s = server.Server('fooserver')
+        message = mock.Mock()
+        message.decode.side_effect = ValueError('test')
+
+        with mock.patch.object(s, '_on_request') as on_request:
+            s._on_message(message)
+
+        self.assertFalse(on_request.called)
+        message.ack.assert_called_once_with()
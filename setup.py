@@ -1,6 +1,7 @@
 import codecs
 import os
 import re
+import sys
 
 import setuptools
 
@@ -17,11 +18,19 @@ def read_version():
             raise RuntimeError('Cannot find version in callme/__init__.py')
 
 
+install_requires = ['kombu>=3.0.0']
+if sys.version_info < (3, 2):
+    install_requires.append('futures>=2.1.3')
+
+
 setuptools.setup(
     name="callme",
     version=read_version(),
     packages=setuptools.find_packages(),
-    install_requires=['kombu>=3.0.0'],
+    install_requires=install_requires,
+    entry_points={
+        'console_scripts': ['callme-server = callme.launcher:main'],
+    },
 
     # metadata for upload to PyPI
     author="Christian Haintz",